@@ -23,13 +23,32 @@ import zipfile
 import requests
 import shutil
 import traceback
+import cProfile
+import sqlite3
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from media_vault import (BackupCatalog, BackupSession, CATALOG_DIR_NAME, DEVICE_FOLDERS, SHARD_POLICIES,
+                         DestinationShards, MirrorReplicator, PARTIAL_SUFFIX, PHOTO_EXTENSIONS, VIDEO_EXTENSIONS,
+                         Tracer, parse_query, trace_span)
+
+# Pillow is optional - only needed for building the thumbnail cache
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 # Global configurations
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 ADB_PATH = os.path.join(SCRIPT_DIR, 'platform-tools', 'adb.exe')
 RESOURCES_DIR = os.path.join(SCRIPT_DIR, 'RESOURCES')
 
-successful_backups = []  # Global list to track successful backups
+# Thumbnail cache settings
+THUMBNAIL_DIR_NAME = '.thumbnails'
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_CACHE_LIMIT = 500 * 1024 * 1024  # 500 MB
+
+ORGANIZED_FOLDERS = ['Photos', 'Videos', 'Other']  # Created by organize_backup_folder
 
 # Define the content for file_operations.py
 file_ops_content = '''import os
@@ -90,6 +109,13 @@ def is_admin():
     except:
         return False
 
+def run_async(coro):
+    """Run a coroutine from the interactive (blocking) code"""
+    if platform.system() == "Windows" and sys.version_info < (3, 8):
+        # asyncio subprocesses need the proactor loop on older Pythons
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    return asyncio.run(coro)
+
 def handle_error(e, show_traceback=False):
     """Handle errors and prevent immediate closing"""
     print("\nError occurred:")
@@ -370,27 +396,28 @@ def get_backup_preferences():
         else:
             print("Invalid choice. Please enter 1 or 2.")
 
-def remove_backed_up_files(successful_files):
+def remove_backed_up_files(session):
     """Remove successfully backed up files from device"""
     print("\nRemoving successfully backed up files from device...")
-    for file_path in successful_files:
-        try:
-            result = subprocess.run([ADB_PATH, 'shell', f'rm "{file_path}"'], 
-                                  capture_output=True, text=True)
-            if result.returncode == 0:
-                print(f"Removed: {os.path.basename(file_path)}")
-            else:
-                print(f"Failed to remove: {os.path.basename(file_path)}")
-        except Exception as e:
-            print(f"Error removing {os.path.basename(file_path)}: {str(e)}")
+    failed = run_async(session.remove_backed_up_files())
+    print(f"Removed: {len(session.successful_files) - len(failed)} files")
+    for file_path in failed:
+        print(f"Failed to remove: {os.path.basename(file_path)}")
     print("\nFile removal completed.")
 
-def organize_backup_folder(backup_dir):
+def organize_backup_folder(backup_dir, catalog=None):
     """Organize backed up files by type and date"""
     print("\nOrganizing backed up files...")
     
-    for root, _, files in os.walk(backup_dir):
+    for root, dirs, files in os.walk(backup_dir):
+        # Skip sidecar folders such as the thumbnail cache
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        # Files inside type folders are already organized
+        if root != backup_dir:
+            dirs[:] = [d for d in dirs if d not in ORGANIZED_FOLDERS]
         for file in files:
+            if file.endswith(PARTIAL_SUFFIX):
+                continue  # Left by an interrupted pull or mirror copy
             file_path = os.path.join(root, file)
             try:
                 # Get file creation/modification time
@@ -399,9 +426,9 @@ def organize_backup_folder(backup_dir):
                 
                 # Determine file type
                 _, ext = os.path.splitext(file.lower())
-                if ext in ['.mp4', '.mov', '.avi']:
+                if ext in VIDEO_EXTENSIONS:
                     type_folder = 'Videos'
-                elif ext in ['.jpg', '.jpeg', '.png']:
+                elif ext in PHOTO_EXTENSIONS:
                     type_folder = 'Photos'
                 else:
                     type_folder = 'Other'
@@ -419,114 +446,327 @@ def organize_backup_folder(backup_dir):
                     new_path = os.path.join(date_path, f"{base}_{int(time.time())}{ext}")
                 
                 os.rename(file_path, new_path)
+                if catalog:
+                    catalog.update_location(file_path, new_path)
                 print(f"Organized: {file} -> {type_folder}/{file_date}/")
                 
             except Exception as e:
                 print(f"Error organizing {file}: {str(e)}")
                 continue
 
-def backup_folder(source_folder, dest_folder, total_files, processed_files, 
-                 successful_files, failed_files, delete_after_backup=False):
-    """Backup a single folder"""
-    print(f"\nProcessing {source_folder}...")
-    print("=" * 50)
-    print(f"Backing up to: {dest_folder}")
-    
-    # Create log file for failed transfers
-    log_file = os.path.join(SCRIPT_DIR, 'failed_transfers.log')
-    
+def file_content_hash(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def thumbnail_path_for(cache_dir, content_hash):
+    """Return the sidecar path for a content hash (sharded by hash prefix)"""
+    return os.path.join(cache_dir, content_hash[:2], f"{content_hash}.jpg")
+
+def create_thumbnail(source_path, cache_dir):
+    """Create the thumbnail for one file (runs in a worker process)
+
+    Returns (source_path, content_hash, error). content_hash is None when no
+    thumbnail could be made. The file is only hashed once a thumbnail was
+    decoded, and nothing is left in the cache when that fails.
+    """
+    _, ext = os.path.splitext(source_path.lower())
+    if ext in PHOTO_EXTENSIONS:
+        if Image is None:
+            return source_path, None, "Pillow is not installed"
+    elif ext in VIDEO_EXTENSIONS:
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            return source_path, None, "ffmpeg not found"
+    else:
+        return source_path, None, "Unsupported file type"
+
+    # Unique per worker process; moved into its hash-prefix folder on success
+    tmp_path = os.path.join(cache_dir, f".{os.getpid()}.tmp")
     try:
-        # Get list of files in the folder
-        result = subprocess.run([ADB_PATH, 'shell', f'find "{source_folder}" -type f'],
-                              capture_output=True, text=True)
-        files = result.stdout.strip().split('\n')
-        files = [f for f in files if f and  # Remove empty entries
-                any(f.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.mp4', '.mov', '.avi'])]
-        
-        # Create destination folder if it doesn't exist
-        os.makedirs(dest_folder, exist_ok=True)
-        
-        # Process each file
-        for file_count, source_path in enumerate(files, 1):
-            file_name = os.path.basename(source_path)
-            dest_path = os.path.join(dest_folder, file_name)
-            
-            # Show progress
-            print_progress(source_folder, file_count, len(files), total_files, processed_files, file_name, dest_path)
-            
-            # Attempt backup with retries
-            if backup_file(source_path, dest_path):
-                successful_files.append(source_path)
-                # Only delete if this folder was selected for backup and deletion was enabled
-                if delete_after_backup and REMOVE_AFTER_BACKUP:
-                    try:
-                        subprocess.run([ADB_PATH, 'shell', f'rm "{source_path}"'])
-                    except Exception as e:
-                        print(f"Warning: Could not delete {source_path}: {str(e)}")
-            else:
-                failed_files.append(source_path)
-                # Log failed transfer
-                with open(log_file, 'a') as f:
-                    f.write(f"Failed to backup: {source_path}\n")
-                    f.write(f"Destination: {dest_path}\n")
-                    f.write(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-                    f.write("-" * 50 + "\n")
-                print(f"\nFailed to backup {file_name} - logged to failed_transfers.log")
-            
-            processed_files += 1
-            
-        # After successful backup, organize the files
-        organize_backup_folder(dest_folder)
-        return True
-        
+        if ext in PHOTO_EXTENSIONS:
+            with Image.open(source_path) as img:
+                # Let the JPEG decoder downscale while decoding - much faster for 12 MP originals
+                img.draft('RGB', THUMBNAIL_SIZE)
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail(THUMBNAIL_SIZE)
+                img.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+        else:
+            width, height = THUMBNAIL_SIZE
+            result = subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', source_path,
+                                     '-vf', f'thumbnail,scale={width}:{height}:force_original_aspect_ratio=decrease',
+                                     '-frames:v', '1', '-f', 'image2', tmp_path],
+                                    capture_output=True, text=True, timeout=120)
+            if result.returncode != 0:
+                return source_path, None, result.stderr.strip() or "ffmpeg failed"
+
+        content_hash = file_content_hash(source_path)
+        thumb_path = thumbnail_path_for(cache_dir, content_hash)
+        # Identical content (e.g. forwarded media) shares one thumbnail
+        if not os.path.exists(thumb_path):
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            os.replace(tmp_path, thumb_path)
+        return source_path, content_hash, None
     except Exception as e:
-        # Log folder-level error
-        with open(log_file, 'a') as f:
-            f.write(f"Error processing folder {source_folder}: {str(e)}\n")
-            f.write(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("-" * 50 + "\n")
-        print(f"\nError processing folder {source_folder}: {str(e)}")
-        print("Error logged to failed_transfers.log")
-        return False
+        return source_path, None, str(e)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
-def print_progress(folder, current, total_folder, total_files, processed_files, current_file, dest_path):
-    """Print progress information"""
-    folder_progress = (current / total_folder) * 100 if total_folder > 0 else 0
-    total_progress = ((processed_files + current) / total_files) * 100 if total_files > 0 else 0
-    
-    print(f"\nCurrent folder: {folder}")
-    print(f"Progress: {folder_progress:.1f}% ({current}/{total_folder})")
-    print(f"Total progress: {total_progress:.1f}% ({processed_files + current}/{total_files})")
-    print(f"Current file: {current_file}")
-    print(f"Destination: {dest_path}")
+def load_thumbnail_index(cache_dir):
+    """Load the thumbnail cache index"""
+    index_path = os.path.join(cache_dir, 'index.json')
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    index.setdefault('files', {})
+    index.setdefault('thumbs', {})
+    return index
+
+def save_thumbnail_index(cache_dir, index):
+    """Atomically save the thumbnail cache index"""
+    index_path = os.path.join(cache_dir, 'index.json')
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
 
-def backup_file(source_path, dest_path, retries=3):
-    """Attempt to backup a file with retries"""
-    for attempt in range(retries):
+def evict_thumbnails(cache_dir, index, max_bytes):
+    """Delete least recently used thumbnails until the cache fits in max_bytes"""
+    thumbs = index['thumbs']
+    for content_hash, entry in thumbs.items():
+        # Browsing the cache updates atime (where the filesystem records it)
         try:
-            print(f"\nBacking up: {os.path.basename(source_path)}")
-            result = subprocess.run([ADB_PATH, 'pull', source_path, dest_path], 
-                                  capture_output=True, text=True, timeout=300)
-            
-            if result.returncode == 0:
-                print(f"Successfully backed up: {os.path.basename(source_path)}")
-                return True
-                
-            if "error: device offline" in result.stderr or "error: no devices/emulators found" in result.stderr:
-                print("\nDevice disconnected. Waiting for reconnection...")
-                wait_for_device()
+            atime = os.stat(thumbnail_path_for(cache_dir, content_hash)).st_atime
+            entry['last_used'] = max(entry.get('last_used', 0), atime)
+        except OSError:
+            entry['bytes'] = 0
+
+    total = sum(entry.get('bytes', 0) for entry in thumbs.values())
+    evicted = 0
+    for content_hash, entry in sorted(thumbs.items(), key=lambda item: item[1].get('last_used', 0)):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(thumbnail_path_for(cache_dir, content_hash))
+        except OSError:
+            pass
+        total -= entry.get('bytes', 0)
+        del thumbs[content_hash]
+        evicted += 1
+    return evicted
+
+def build_thumbnail_cache(backup_dir, max_workers=None, max_bytes=THUMBNAIL_CACHE_LIMIT):
+    """Build thumbnails for newly backed up media in parallel worker processes"""
+    print("\nBuilding thumbnail cache...")
+    cache_dir = os.path.join(backup_dir, THUMBNAIL_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    index = load_thumbnail_index(cache_dir)
+
+    # Files no decoder is available for are skipped before any work is done on them
+    extensions = []
+    if Image is None:
+        print("Pillow not installed - photo thumbnails will be skipped (pip install Pillow)")
+    else:
+        extensions += PHOTO_EXTENSIONS
+    if not shutil.which('ffmpeg'):
+        print("ffmpeg not found - video poster frames will be skipped")
+    else:
+        extensions += VIDEO_EXTENSIONS
+
+    # Only files that are new or changed since the last run need work, including files that failed
+    pending = {}
+    for root, dirs, files in os.walk(backup_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            _, ext = os.path.splitext(file.lower())
+            if file.endswith(PARTIAL_SUFFIX) or ext not in extensions:
                 continue
-                
-        except subprocess.TimeoutExpired:
-            print(f"\nTimeout occurred. Retrying... (Attempt {attempt + 1}/{retries})")
-            continue
-            
-        except Exception as e:
-            print(f"\nError occurred: {str(e)}")
-            
-        print(f"\nRetrying file transfer... (Attempt {attempt + 1}/{retries})")
+            file_path = os.path.join(root, file)
+            rel_path = os.path.relpath(file_path, backup_dir)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entry = index['files'].get(rel_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            pending[file_path] = (rel_path, stat)
+
+    if not pending:
+        print("Thumbnail cache is up to date.")
+        return True
+
+    print(f"Creating thumbnails for {len(pending)} files...")
+    created = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(create_thumbnail, file_path, cache_dir) for file_path in pending]
+        for future in as_completed(futures):
+            source_path, content_hash, error = future.result()
+            rel_path, stat = pending[source_path]
+            if content_hash is None:
+                # Not retried until the file changes
+                index['files'][rel_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None,
+                                            'error': error}
+                failed += 1
+                print(f"Skipped thumbnail for {os.path.basename(source_path)}: {error}")
+                continue
+            index['files'][rel_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': content_hash}
+            try:
+                thumb_bytes = os.path.getsize(thumbnail_path_for(cache_dir, content_hash))
+            except OSError:
+                thumb_bytes = 0
+            index['thumbs'][content_hash] = {'bytes': thumb_bytes, 'last_used': time.time()}
+            created += 1
+
+    evicted = evict_thumbnails(cache_dir, index, max_bytes)
+    save_thumbnail_index(cache_dir, index)
+
+    print(f"Thumbnails created: {created}, skipped: {failed}, evicted: {evicted}")
+    print(f"Thumbnail cache: {cache_dir}")
+    return True
+
+def run_query(backup_dir, query, limit=100):
+    """Answer a catalog query without touching the backed up files"""
+    db_path = os.path.join(backup_dir, CATALOG_DIR_NAME, 'catalog.db')
+    if not os.path.exists(db_path):
+        print(f"No backup catalog found at: {db_path}")
+        return False
     
-    return False
+    try:
+        filters = parse_query(query)
+        start = time.perf_counter()
+        catalog = BackupCatalog(backup_dir)
+        total, rows = catalog.query(filters, limit)
+        catalog.close()
+        elapsed = (time.perf_counter() - start) * 1000
+    except (ValueError, sqlite3.Error) as e:
+        print(f"Query failed: {str(e)}")
+        print("Fields: type, source, device, date, from, to, min_size, max_size")
+        print('Example: --query "type=video source=TikTok date=2024-03"')
+        return False
+    
+    for file_date, media_type, source_name, device, size, dest_path in rows:
+        print(f"{file_date}  {media_type:<5}  {source_name:<15}  {size / (1024 * 1024):>8.1f} MB  {dest_path}")
+    
+    print(f"\n{total} matching files ({elapsed:.1f} ms)")
+    if total > len(rows):
+        print(f"Showing first {len(rows)} - use --limit to see more")
+    return True
+
+def format_bytes(size):
+    """Format a byte count for display"""
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def format_duration(seconds):
+    """Format seconds as H:MM:SS"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+class ProgressRenderer:
+    """Single-line progress display, redrawn in place at most max_rate times a second"""
+
+    def __init__(self, total_files, total_bytes, quiet=False, max_rate=10):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.quiet = quiet
+        self.min_interval = 1.0 / max_rate
+        self.files_done = 0
+        self.bytes_done = 0
+        self.bytes_in_flight = 0  # Partly pulled bytes of transfers still running
+        self.folder = ''
+        self.concurrency = None
+        self.start_time = time.monotonic()
+        self.last_draw = 0
+        self.last_bytes = 0
+        self.rate = None  # Smoothed bytes/s
+        self.line_length = 0
+
+    def message(self, text):
+        """Print a full line above the progress line"""
+        if self.quiet:
+            return
+        self._clear()
+        print(text)
+        self._redraw(force=True)
+
+    def file_finished(self, size):
+        self.files_done += 1
+        self.bytes_done += size
+        self._redraw()
+
+    def set_in_flight(self, size):
+        """Update the bytes pulled so far by unfinished transfers (called on a timer)"""
+        self.bytes_in_flight = size
+        self._redraw()
+
+    def set_concurrency(self, limit):
+        self.concurrency = limit
+        self._redraw()
+
+    def set_folder(self, folder):
+        self.folder = os.path.basename(folder.rstrip('/'))
+        self._redraw(force=True)
+
+    def finish(self):
+        if self.quiet:
+            return
+        self._redraw(force=True)
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+        self.line_length = 0
+
+    def _clear(self):
+        if self.line_length:
+            sys.stdout.write('\r' + ' ' * self.line_length + '\r')
+            self.line_length = 0
+
+    def _redraw(self, force=False):
+        if self.quiet:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_draw < self.min_interval:
+            return
+        
+        # Smooth the rate so one large video doesn't swing the ETA
+        bytes_done = min(self.bytes_done + self.bytes_in_flight, self.total_bytes)
+        elapsed = now - self.last_draw if self.last_draw else now - self.start_time
+        if elapsed > 0:
+            current_rate = max(0, bytes_done - self.last_bytes) / elapsed
+            self.rate = current_rate if self.rate is None else 0.7 * self.rate + 0.3 * current_rate
+        self.last_draw = now
+        self.last_bytes = bytes_done
+        
+        percent = (bytes_done / self.total_bytes * 100) if self.total_bytes else 100.0
+        filled = int(percent / 5)
+        bar = '#' * filled + '.' * (20 - filled)
+        line = (f"[{bar}] {percent:5.1f}%  {format_bytes(bytes_done)}/{format_bytes(self.total_bytes)}  "
+                f"{self.files_done}/{self.total_files} files")
+        if self.rate:
+            line += f"  {self.rate / (1024 * 1024):.1f} MB/s"
+            remaining = max(0, self.total_bytes - bytes_done)
+            line += f"  ETA {format_duration(remaining / self.rate)}"
+        if self.concurrency:
+            line += f"  x{self.concurrency}"
+        if self.folder:
+            line += f"  {self.folder}"
+        
+        width = shutil.get_terminal_size((80, 20)).columns - 1
+        line = line[:width]
+        sys.stdout.write('\r' + line + ' ' * max(0, self.line_length - len(line)))
+        sys.stdout.flush()
+        self.line_length = len(line)
 
 def prompt_continue():
     """Prompt user whether to continue after error"""
@@ -547,6 +787,29 @@ def parse_args():
     parser.add_argument('--clean', action='store_true', help='Delete files after backup')
     parser.add_argument('--report', action='store_true', help='Generate backup report')
     parser.add_argument('--verify', action='store_true', help='Verify existing backups')
+    parser.add_argument('--thumbnails', action='store_true', help='Build thumbnail cache after backup')
+    parser.add_argument('--quiet', action='store_true', help='No progress output (for unattended runs)')
+    parser.add_argument('--query', metavar='QUERY', help='Search the backup catalog, e.g. "type=video source=TikTok date=2024-03"')
+    parser.add_argument('--limit', type=int, default=100, help='Maximum number of query results (or --plan files per folder) to show')
+    parser.add_argument('--watch', action='store_true', help='Keep running and back up new media as it appears')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between checks for new media in --watch mode')
+    parser.add_argument('--plan', action='store_true',
+                        help='Dry run: list what would be backed up and estimate how long it takes')
+    parser.add_argument('--dest', action='append', metavar='DIR',
+                        help='Extra destination root to spread files over (can be repeated)')
+    parser.add_argument('--shard-policy', choices=SHARD_POLICIES, default='round-robin',
+                        help='How files are spread over the destination roots (by-folder keeps each device '
+                             'folder on one disk and backs up folders on different disks in parallel)')
+    parser.add_argument('--mirror', action='append', metavar='DIR',
+                        help='Also copy files added by the backup to DIR (can be repeated)')
+    parser.add_argument('--max-transfers', type=int, default=8,
+                        help='Most transfers in flight per destination (adjusted automatically up to this)')
+    parser.add_argument('--fixed-transfers', action='store_true',
+                        help='Always run --max-transfers transfers instead of adapting to the device')
+    parser.add_argument('--profile', nargs='?', const='', metavar='TRACE_FILE',
+                        help='Record timings of each stage and file as a Chrome trace JSON')
+    parser.add_argument('--cprofile', metavar='STATS_FILE', help='Also write cProfile statistics to STATS_FILE')
+    parser.add_argument('--backup-dir', default=os.path.join(SCRIPT_DIR, 'Backup'), help='Backup location used by --query, --plan and --watch')
     parser.add_argument('--setup', action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('--install-adb', action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('--first-run', action='store_true', help=argparse.SUPPRESS)
@@ -582,8 +845,24 @@ def setup_resources():
         handle_error(f"Error setting up resources: {e}", show_traceback=True)
         return False
 
-def main():
+def main(args=None):
     """Main program execution"""
+    if args is None:
+        args = parse_args()
+    
+    # Catalog queries never need the device or the backup folders
+    if args.query:
+        run_query(args.backup_dir, args.query, args.limit)
+        return
+    
+    if args.plan:
+        plan_mode(args)
+        return
+    
+    if args.watch:
+        watch_mode(args)
+        return
+    
     print_header()
     
     # Get user preferences for file removal
@@ -615,28 +894,62 @@ def main():
     # Get user selection for backup
     folders_to_backup = select_backup_folders()
     
-    # Track successful and failed backups
-    successful_files = []
-    failed_files = []
+    # Index backed up files as they arrive
+    catalog = BackupCatalog(backup_dir)
+    tracer = Tracer() if args.profile is not None else None
+    shards = get_destination_shards(backup_dir, args)
+    mirror = get_mirror(shards, args)
+    session = BackupSession(ADB_PATH, backup_dir, folders_to_backup, catalog=catalog,
+                            failure_log=os.path.join(SCRIPT_DIR, 'failed_transfers.log'), tracer=tracer,
+                            shards=shards, max_concurrent_transfers=args.max_transfers,
+                            adaptive=not args.fixed_transfers, mirror=mirror)
     
     # Start the backup process
-    if start_backup(backup_dir, folders_to_backup, successful_files, failed_files):
-        if remove_files and successful_files:
-            remove_backed_up_files(successful_files)
+    if start_backup(session, args.quiet):
+        if remove_files and session.successful_files:
+            with trace_span(tracer, 'remove files'):
+                remove_backed_up_files(session)
         
         # Organize all backed up files
         print("\nOrganizing backed up files by type and date...")
-        organize_backup_folder(backup_dir)
+        with trace_span(tracer, 'organize'):
+            for root in shards.roots:
+                organize_backup_folder(root, catalog)
+            for root in mirror.roots if mirror else []:
+                organize_backup_folder(root)
+        
+        # Optional post-backup stage
+        if args.thumbnails:
+            with trace_span(tracer, 'thumbnails'):
+                for root in shards.roots:
+                    build_thumbnail_cache(root)
+    
+    catalog.close()
+    if mirror:
+        mirror.close()
+    if tracer:
+        save_trace(tracer, args.profile)
     
     # Print final summary
+    successful_files = session.successful_files
+    failed_files = session.failed_files
     print("\n" + "=" * 50)
     print("Backup Process Complete!")
     print("=" * 50)
     print(f"Successfully backed up: {len(successful_files)} files")
     print(f"Failed transfers: {len(failed_files)} files")
+    print(f"Duplicates skipped: {session.duplicates_skipped} files")
+    print(f"Already backed up: {session.already_backed_up} files")
+    if session.suspect_files:
+        print(f"Kept but failed the integrity check (left on device): {len(session.suspect_files)} files")
+    if mirror:
+        print_mirror_summary(mirror)
+    
+    if session.failed_folders:
+        print(f"Folders that could not be read: {', '.join(session.failed_folders)}")
     
-    if os.path.exists('failed_transfers.log'):
-        print("\nDetailed error log available in: failed_transfers.log")
+    if os.path.exists(session.failure_log):
+        print(f"\nDetailed error log available in: {session.failure_log}")
     
     if failed_files:
         print("\nFailed files:")
@@ -647,26 +960,185 @@ def main():
     
     input("\nPress Enter to exit...")
 
-def start_backup(backup_dir, folders_to_backup, successful_files, failed_files):
+def plan_mode(args):
+    """Show what a backup would transfer and how long it would take (--plan)"""
+    try:
+        ensure_adb_available()
+    except Exception as e:
+        handle_error(f"ADB setup failed: {str(e)}", show_traceback=True)
+        return
+    
+    print("\nWaiting for device connection...")
+    wait_for_device()
+    
+    catalog = BackupCatalog(args.backup_dir)
+    tracer = Tracer() if args.profile is not None else None
+    session = BackupSession(ADB_PATH, args.backup_dir, get_device_folders(), catalog=catalog, tracer=tracer)
+    start = time.perf_counter()
+    try:
+        plan = run_async(session.plan())
+    finally:
+        catalog.close()
+    elapsed = time.perf_counter() - start
+    
+    print(f"\nBackup plan for {catalog.device} (nothing was transferred)")
+    for folder_plan in plan.folders:
+        if folder_plan.error:
+            print(f"\n{folder_plan.folder}\n  Could not be scanned: {folder_plan.error}")
+            continue
+        if not folder_plan.total_files:
+            continue
+        if folder_plan.calibration_runs:
+            model = f"calibrated on {folder_plan.calibration_runs} runs"
+        else:
+            model = "no past runs, default speed"
+        print(f"\n{folder_plan.folder}")
+        print(f"  New: {len(folder_plan.new)} files ({format_bytes(folder_plan.new_bytes)})")
+        print(f"  Duplicates: {len(folder_plan.duplicates)} files")
+        print(f"  Already backed up: {len(folder_plan.backed_up)} files")
+        print(f"  Estimate: {format_duration(folder_plan.estimated_seconds)} "
+              f"({format_bytes(folder_plan.bytes_per_second)}/s, "
+              f"{folder_plan.per_file_seconds * 1000:.0f} ms per pulled file, "
+              f"{folder_plan.check_seconds * 1000:.0f} ms per file checked on the device; {model})")
+        for label, paths in (('new', folder_plan.new), ('duplicate', folder_plan.duplicates)):
+            for path in paths[:args.limit]:
+                print(f"    {label:<9}  {os.path.basename(path)}")
+            if len(paths) > args.limit:
+                print(f"    ... and {len(paths) - args.limit} more {label} files")
+    
+    new_files = sum(len(f.new) for f in plan.folders)
+    new_bytes = sum(f.new_bytes for f in plan.folders)
+    print(f"\nTotal: {new_files} new files ({format_bytes(new_bytes)}), "
+          f"estimated {format_duration(plan.estimated_seconds)}")
+    print(f"Planned in {elapsed:.1f}s")
+    if tracer:
+        save_trace(tracer, args.profile)
+
+def watch_mode(args):
+    """Back up new media continuously without prompts (--watch)"""
+    try:
+        ensure_adb_available()
+    except Exception as e:
+        handle_error(f"ADB setup failed: {str(e)}", show_traceback=True)
+        return
+    
+    backup_dir = args.backup_dir
+    os.makedirs(backup_dir, exist_ok=True)
+    catalog = BackupCatalog(backup_dir)
+    tracer = Tracer() if args.profile is not None else None
+    shards = get_destination_shards(backup_dir, args)
+    mirror = get_mirror(shards, args)
+    session = BackupSession(ADB_PATH, backup_dir, get_device_folders(), catalog=catalog,
+                            failure_log=os.path.join(SCRIPT_DIR, 'failed_transfers.log'), tracer=tracer,
+                            shards=shards, max_concurrent_transfers=args.max_transfers,
+                            adaptive=not args.fixed_transfers, mirror=mirror)
+    
+    print(f"\nWatching for new media (checking every {args.interval:g}s)")
+    print(f"Backup Location: {os.path.abspath(backup_dir)}")
+    print("Press Ctrl+C to stop.")
+    
+    async def watch():
+        async for result in session.watch(args.interval):
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            print(f"\n[{timestamp}] Backed up: {len(result.successful_files)}, "
+                  f"failed: {len(result.failed_files)}, duplicates skipped: {result.duplicates_skipped}, "
+                  f"already backed up: {result.already_backed_up}")
+            if result.suspect_files:
+                print(f"Kept {len(result.suspect_files)} files that failed the integrity check (left on device)")
+            for folder in result.failed_folders:
+                print(f"Could not read {folder} - will retry on the next pass")
+            if args.clean and result.successful_files:
+                with trace_span(tracer, 'remove files'):
+                    failed = await session.remove_backed_up_files(result.successful_files)
+                print(f"Removed {len(result.successful_files) - len(failed)} files from device")
+            with trace_span(tracer, 'organize'):
+                for root in shards.roots:
+                    organize_backup_folder(root, catalog)
+                for root in mirror.roots if mirror else []:
+                    organize_backup_folder(root)
+            catalog.commit()
+            if args.thumbnails:
+                with trace_span(tracer, 'thumbnails'):
+                    for root in shards.roots:
+                        build_thumbnail_cache(root)
+    
+    try:
+        run_async(watch())
+    finally:
+        catalog.close()
+        if mirror:
+            mirror.close()
+        if tracer:
+            save_trace(tracer, args.profile)
+
+def get_destination_shards(backup_dir, args):
+    """Combine the backup location with any extra --dest roots"""
+    shards = DestinationShards([backup_dir] + (args.dest or []), args.shard_policy)
+    if len(shards.roots) > 1:
+        print(f"\nSpreading files over {len(shards.roots)} destinations ({shards.policy}):")
+        for root in shards.roots:
+            print(f"- {root} ({shards.free[root] / (1024 ** 3):.1f} GB free)")
+    return shards
+
+def get_mirror(shards, args):
+    """Set up replication to the --mirror roots, if any"""
+    if not args.mirror:
+        return None
+    roots = [os.path.abspath(root) for root in args.mirror]
+    for root in roots:
+        if root in shards.roots:
+            handle_error(f"Mirror {root} is also a backup destination")
+    mirror = MirrorReplicator(roots)
+    print(f"\nMirroring new files to: {', '.join(mirror.roots)}")
+    return mirror
+
+def print_mirror_summary(mirror):
+    """Report what the mirror stage copied"""
+    methods = ', '.join(f"{count} by {method}" for method, count in sorted(mirror.methods.items()))
+    print(f"Mirrored: {mirror.copied} copies ({format_bytes(mirror.copied_bytes)})"
+          + (f" - {methods}" if methods else ""))
+    if mirror.failed:
+        print(f"Mirror copies failed: {mirror.failed} (see failed_transfers.log)")
+
+def save_trace(tracer, path):
+    """Write the --profile trace"""
+    if not path:
+        path = os.path.join(SCRIPT_DIR, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    tracer.save(path)
+    print(f"\nTrace saved to: {path}")
+    print("Open it in chrome://tracing, https://ui.perfetto.dev or https://www.speedscope.app")
+
+def scan_folders(session):
+    """Scan the session's folders on the device (results are kept on the session)"""
+    async def scan():
+        with trace_span(session.tracer, 'inventory'):
+            return [folder_inventory async for folder_inventory in session.inventory()]
+    return run_async(scan())
+
+def start_backup(session, quiet=False):
     """Start the backup process with the selected folders"""
-    if not backup_dir:
+    if not session.backup_dir:
         print("Error: Backup location not set!")
         return False
-        
+    
     # Scan selected folders
-    print("\nScanning folders...")
-    total_files = 0
-    total_size = 0
-    folder_info = []  # Store info about each folder
-    
-    for i, folder in enumerate(folders_to_backup, 1):
-        files, size = scan_folder(folder)
-        if files > 0:
-            print(f"{i}. Found {files} files in {folder} ({size:.1f} MB)")
-            folder_info.append((folder, files, size))
-            total_files += files
-            total_size += size
+    if not session.folder_inventory:
+        print("\nScanning folders...")
+        scan_folders(session)
+    
+    for folder in session.folders:
+        if session.folder_inventory[folder].error:
+            print(f"Could not scan {folder}: {session.folder_inventory[folder].error}")
     
+    # Only folders with media can be picked
+    folder_info = [session.folder_inventory[folder] for folder in session.folders
+                   if session.folder_inventory[folder].files]
+    for i, folder_inventory in enumerate(folder_info, 1):
+        size = folder_inventory.total_size / (1024 * 1024)
+        print(f"{i}. Found {len(folder_inventory.files)} files in {folder_inventory.folder} ({size:.1f} MB)")
+    
+    total_files = sum(len(f.files) for f in folder_info)
+    total_size = sum(f.total_size for f in folder_info) / (1024 * 1024)
     print(f"\nTotal files to backup: {total_files}")
     print(f"Total size: {total_size:.1f} MB")
     
@@ -685,49 +1157,83 @@ def start_backup(backup_dir, folders_to_backup, successful_files, failed_files):
             # Validate all indices before proceeding
             if not all(0 <= i < len(folder_info) for i in selected_indices):
                 print("Invalid folder number(s). Please try again.")
-                return start_backup(backup_dir, folders_to_backup, successful_files, failed_files)
+                return start_backup(session, quiet)
             
-            folders_to_backup = [folder_info[i][0] for i in selected_indices]
+            selected = [folder_info[i] for i in selected_indices]
+            session.folders = [f.folder for f in selected]
             
             # Recalculate totals for selected folders
-            total_files = sum(folder_info[i][1] for i in selected_indices)
-            total_size = sum(folder_info[i][2] for i in selected_indices)
+            total_files = sum(len(f.files) for f in selected)
+            total_size = sum(f.total_size for f in selected) / (1024 * 1024)
             
-            print(f"\nSelected {len(folders_to_backup)} folders")
+            print(f"\nSelected {len(session.folders)} folders")
             print(f"Files to backup: {total_files}")
             print(f"Total size: {total_size:.1f} MB")
             
             if not input("\nPress Enter to continue or 'q' to quit: ").lower().startswith('q'):
-                return process_backup(backup_dir, folders_to_backup, total_files, successful_files, failed_files)
+                return process_backup(session, total_files, sum(f.total_size for f in selected), quiet)
             return False
             
         except (ValueError, IndexError) as e:
             print(f"Invalid selection format. Please try again.")
-            return start_backup(backup_dir, folders_to_backup, successful_files, failed_files)
+            return start_backup(session, quiet)
     
     # If user pressed Enter or entered '0', proceed with all folders
     if not input("\nPress Enter to continue or 'q' to quit: ").lower().startswith('q'):
-        return process_backup(backup_dir, folders_to_backup, total_files, successful_files, failed_files)
+        return process_backup(session, total_files, sum(f.total_size for f in folder_info), quiet)
     return False
 
-def process_backup(backup_dir, folders_to_backup, total_files, successful_files, failed_files):
-    """Process the actual backup of selected folders"""
-    processed_files = 0
+def process_backup(session, total_files, total_bytes, quiet=False):
+    """Run the backup session, rendering its progress events"""
+    progress = ProgressRenderer(total_files, total_bytes, quiet)
     
-    # Create a set of selected folder paths for easy lookup
-    selected_folder_paths = {os.path.normpath(folder) for folder in folders_to_backup}
+    async def tick():
+        # Events only arrive when a file finishes - keep bytes and ETA moving during long pulls
+        while True:
+            await asyncio.sleep(0.5)
+            progress.set_in_flight(session.bytes_in_flight())
     
-    for folder in folders_to_backup:
-        dest_folder = os.path.join(backup_dir, os.path.basename(folder))
-        
-        # Only process deletion for folders that were explicitly selected
-        delete_after_backup = folder in selected_folder_paths
-        
-        if not backup_folder(folder, dest_folder, total_files, processed_files, 
-                           successful_files, failed_files, delete_after_backup):
-            print("\nBackup process interrupted.")
-            return False
-            
+    async def run():
+        events = session.events()
+        task = asyncio.ensure_future(session.run())
+        ticker = None if quiet else asyncio.ensure_future(tick())
+        try:
+            await show_events(events)
+        finally:
+            if ticker:
+                ticker.cancel()
+        return await task
+    
+    async def show_events(events):
+        async for event in events:
+            if event.kind == 'folder_started':
+                progress.message(f"Processing {event.folder} -> {event.dest_path}")
+                progress.set_folder(event.folder)
+            elif event.kind in ('file_done', 'file_skipped'):
+                progress.file_finished(event.size)
+                if event.error:
+                    progress.message(f"Kept {os.path.basename(event.path)} but it will stay on the device: "
+                                     f"{event.error}")
+            elif event.kind == 'file_failed':
+                progress.file_finished(event.size)
+                progress.message(f"Failed to backup {os.path.basename(event.path)} - logged to failed_transfers.log")
+            elif event.kind == 'file_retry':
+                progress.message(f"Retrying {os.path.basename(event.path)} "
+                                 f"(Attempt {event.attempt}/{session.retries}): {event.error}")
+            elif event.kind == 'concurrency_changed':
+                progress.set_concurrency(event.count)
+            elif event.kind == 'device_disconnected':
+                progress.message("Device disconnected. Waiting for reconnection...")
+            elif event.kind == 'folder_failed':
+                progress.message(f"Error processing folder {event.folder}: {event.error}")
+            elif event.kind == 'mirror_failed':
+                progress.message(f"Failed to mirror {os.path.basename(event.path)}: {event.error}")
+    
+    result = run_async(run())
+    progress.finish()
+    if result.cancelled:
+        print("\nBackup process interrupted.")
+        return False
     return True
 
 def setup_backup_location():
@@ -786,62 +1292,7 @@ def setup_backup_location():
 
 def get_device_folders():
     """Get list of folders and files to scan on device"""
-    base_paths = [
-        # DCIM directory and its subdirectories
-        '/storage/emulated/0/DCIM',
-        '/storage/emulated/0/DCIM/Camera',
-        '/storage/emulated/0/DCIM/Videocaptures',
-        '/storage/emulated/0/DCIM/Video Editor',
-        '/storage/emulated/0/DCIM/Snapchat',
-        '/storage/emulated/0/DCIM/Screen recordings',
-        '/storage/emulated/0/DCIM/RedTiger',
-        '/storage/emulated/0/DCIM/Facebook',
-        '/storage/emulated/0/DCIM/Dicks Refund',
-        # Movies directory and its subdirectories
-        '/storage/emulated/0/Movies',
-        '/storage/emulated/0/Movies/TikTok',
-        '/storage/emulated/0/Movies/Facetune'
-    ]
-    
-    return base_paths
-
-def scan_folder(folder_path):
-    """Scan a folder for media files"""
-    try:
-        # First, check if the folder exists
-        check_result = subprocess.run([ADB_PATH, 'shell', f'[ -d "{folder_path}" ] && echo "exists"'],
-                                    capture_output=True, text=True)
-        
-        files = []
-        total_size = 0
-        
-        # If it's a directory, scan recursively
-        if "exists" in check_result.stdout:
-            result = subprocess.run([ADB_PATH, 'shell', f'find "{folder_path}" -type f -name "*.*"'],
-                                  capture_output=True, text=True)
-            files.extend([f for f in result.stdout.strip().split('\n') if f and 
-                       any(f.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.mp4', '.mov', '.avi', '.mp3'])])
-        
-        # Also check if it's a direct file path
-        else:
-            result = subprocess.run([ADB_PATH, 'shell', f'[ -f "{folder_path}" ] && echo "{folder_path}"'],
-                                  capture_output=True, text=True)
-            if result.stdout.strip():
-                files.append(folder_path)
-        
-        # Calculate total size
-        for file in files:
-            size_result = subprocess.run([ADB_PATH, 'shell', f'stat -c%s "{file}"'],
-                                       capture_output=True, text=True)
-            try:
-                total_size += int(size_result.stdout.strip())
-            except ValueError:
-                continue
-                
-        return len(files), total_size / (1024 * 1024)  # Convert to MB
-    except Exception as e:
-        print(f"Error scanning {folder_path}: {str(e)}")
-        return 0, 0
+    return list(DEVICE_FOLDERS)
 
 def select_backup_folders():
     """Let user select which folders to backup"""
@@ -872,7 +1323,11 @@ def select_backup_folders():
 
 if __name__ == "__main__":
     try:
-        main()
+        args = parse_args()
+        if args.cprofile:
+            cProfile.run('main(args)', args.cprofile)
+        else:
+            main(args)
     except KeyboardInterrupt:
         print("\n\nOperation cancelled by user.")
         input("\nPress Enter to exit...")
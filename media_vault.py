@@ -0,0 +1,1850 @@
+#!/usr/bin/env python
+"""
+AndroidMediaVault backup engine
+
+asyncio API behind android-media_vault.py, usable from other services:
+
+    session = BackupSession(adb_path, backup_dir, folders, catalog=catalog)
+    async for folder in session.inventory():
+        print(folder.folder, len(folder.files), folder.total_size)
+
+    events = session.events()
+    task = asyncio.ensure_future(session.run())
+    async for event in events:
+        print(event.kind, event.path)
+    result = await task
+"""
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+try:
+    import fcntl  # Reflink copies (Linux only)
+except ImportError:
+    fcntl = None
+
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi']
+MEDIA_EXTENSIONS = PHOTO_EXTENSIONS + VIDEO_EXTENSIONS
+
+# Folders scanned on the device by default
+DEVICE_FOLDERS = [
+    # DCIM directory and its subdirectories
+    '/storage/emulated/0/DCIM',
+    '/storage/emulated/0/DCIM/Camera',
+    '/storage/emulated/0/DCIM/Videocaptures',
+    '/storage/emulated/0/DCIM/Video Editor',
+    '/storage/emulated/0/DCIM/Snapchat',
+    '/storage/emulated/0/DCIM/Screen recordings',
+    '/storage/emulated/0/DCIM/RedTiger',
+    '/storage/emulated/0/DCIM/Facebook',
+    '/storage/emulated/0/DCIM/Dicks Refund',
+    # Movies directory and its subdirectories
+    '/storage/emulated/0/Movies',
+    '/storage/emulated/0/Movies/TikTok',
+    '/storage/emulated/0/Movies/Facetune'
+]
+
+# Backup catalog settings
+CATALOG_DIR_NAME = '.catalog'
+
+# Watch mode: files newer than this device-side marker have not been backed up yet
+WATCH_MARKER = '/storage/emulated/0/.media_vault_marker'
+WATCH_RETRY_INTERVAL = 3600  # Seconds between watch mode retries of failed files
+WATCH_MAX_ATTEMPTS = 5  # Failed transfers are given up after this many attempts
+
+# Files being written (pulls and mirror copies) get this suffix until complete
+PARTIAL_SUFFIX = '.part'
+
+# Pull timeouts grow with the file size: base timeout plus the size at this rate
+MIN_PULL_THROUGHPUT = 512 * 1024  # Bytes per second - a pull sharing a slow link with others
+
+# How files are spread over several destination roots
+SHARD_POLICIES = ['round-robin', 'free-space', 'by-folder']
+
+# Duplicate detection settings
+FINGERPRINT_CHUNK = 64 * 1024  # Bytes hashed from the start and the end of each file
+SHELL_BATCH_SIZE = 500  # Paths passed per adb shell call
+
+# Dry-run estimates until past runs have been recorded
+DEFAULT_CHECK_SECONDS = 0.02  # Seconds to fingerprint one file on the device
+DEFAULT_FILE_OVERHEAD = 0.05  # Seconds per pulled file
+DEFAULT_THROUGHPUT = 20 * 1024 * 1024  # Bytes per second
+PLAN_HISTORY = 20  # Most recent runs used to calibrate an estimate
+
+# Mirror replication settings
+FICLONE = 0x40049409  # ioctl sharing a file's blocks on btrfs/XFS (reflink)
+MIRROR_WORKERS = 4  # Copies in flight per mirror root
+
+def get_media_type(file_name):
+    """Return 'photo', 'video' or 'other' for a file name"""
+    _, ext = os.path.splitext(file_name.lower())
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in PHOTO_EXTENSIONS:
+        return 'photo'
+    return 'other'
+
+def is_media_file(file_name):
+    """Check if a file name has one of the backed up media extensions"""
+    return os.path.splitext(file_name.lower())[1] in MEDIA_EXTENSIONS
+
+def find_name_filter():
+    """Return a find expression matching the media extensions"""
+    names = ' -o '.join(f'-iname "*{ext}"' for ext in MEDIA_EXTENSIONS)
+    return f'\\( {names} \\)'
+
+def source_name_for(source_path, source_folder=None):
+    """Name a device file's source: its most specific scanned folder
+
+    DEVICE_FOLDERS nest (/Movies and /Movies/TikTok), and a folder is
+    scanned recursively, so the scanned folder alone would file TikTok
+    videos under Movies. Files outside every known folder are named after
+    their parent directory.
+    """
+    folders = DEVICE_FOLDERS + [source_folder] if source_folder else DEVICE_FOLDERS
+    best = None
+    for folder in folders:
+        folder = folder.rstrip('/')
+        if source_path.startswith(folder + '/') and (best is None or len(folder) > len(best)):
+            best = folder
+    return os.path.basename(best if best is not None else os.path.dirname(source_path))
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    """Return the MD5 hex digest of a local file (matches md5sum on the device)"""
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_file_fast(source, dest):
+    """Copy a file's data without passing it through Python where possible
+
+    Tries a reflink (no data copied at all), then os.copy_file_range and
+    os.sendfile (copied inside the kernel), then shutil.copyfile. Returns
+    the method used.
+    """
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        size = os.fstat(src.fileno()).st_size
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            copied = 0
+            try:
+                while copied < size:
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, copied, copied)
+                    else:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+            except OSError:
+                pass
+            if copied == size:
+                return method
+            dst.seek(0)
+            dst.truncate()
+    shutil.copyfile(source, dest)
+    return 'copy'
+
+JPEG_TAIL_SCAN = 4096  # Bytes searched for the EOI marker (trailing padding is allowed)
+MAX_TOP_LEVEL_BOXES = 100000
+
+def check_media_integrity(file_path, expected_size=None, file_name=None):
+    """Cheap structural check of a pulled file; returns None if it looks whole
+
+    Only a few KB are read: JPEG SOI/EOI markers, the PNG IEND chunk, or the
+    top-level box/chunk headers of MP4/MOV/AVI files. Otherwise returns a
+    short description of the problem. The format is taken from file_name
+    (default file_path), so temporary files can be checked.
+    """
+    try:
+        size = os.path.getsize(file_path)
+        if expected_size is not None and size != expected_size:
+            return f"size {size} does not match device size {expected_size}"
+        if size == 0:
+            return "file is empty"
+        _, ext = os.path.splitext((file_name or file_path).lower())
+        with open(file_path, 'rb') as f:
+            if ext in ('.jpg', '.jpeg'):
+                return _check_jpeg(f)
+            if ext == '.png':
+                return _check_png(f)
+            if ext in ('.mp4', '.mov'):
+                return _check_boxes(f, size)
+            if ext == '.avi':
+                return _check_riff(f, size)
+    except (OSError, ValueError) as e:
+        return str(e)
+    return None
+
+def _check_jpeg(f):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:2] != b'\xff\xd8':
+            return "missing JPEG start marker"
+        tail_start = max(0, len(m) - JPEG_TAIL_SCAN)
+        if m.rfind(b'\xff\xd9', tail_start) != -1:
+            return None
+        # Samsung motion photos and similar append data after the image
+        if m[-4:] == b'SEFT' or m.find(b'MotionPhoto', 0, 65536) != -1 or m.find(b'MicroVideo', 0, 65536) != -1:
+            return None
+    return "missing JPEG end marker (truncated?)"
+
+def _check_png(f):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:8] != b'\x89PNG\r\n\x1a\n':
+            return "missing PNG signature"
+        if m[-12:] != b'\x00\x00\x00\x00IEND\xaeB`\x82':
+            return "missing PNG IEND chunk (truncated?)"
+    return None
+
+def _check_boxes(f, size):
+    """Walk MP4/MOV top-level boxes; they must tile the file and include moov"""
+    offset = 0
+    seen = set()
+    for _ in range(MAX_TOP_LEVEL_BOXES):
+        if offset == size:
+            break
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return f"truncated box header at offset {offset}"
+        box_size, box_type = struct.unpack('>I4s', header)
+        if box_size == 1:
+            large = f.read(8)
+            if len(large) < 8:
+                return f"truncated box header at offset {offset}"
+            box_size = struct.unpack('>Q', large)[0]
+        elif box_size == 0:
+            box_size = size - offset  # Box runs to the end of the file
+        if box_size < 8 or offset + box_size > size:
+            return f"box at offset {offset} runs past the end of the file (truncated?)"
+        seen.add(box_type)
+        offset += box_size
+    else:
+        return "too many top-level boxes"
+    if b'moov' not in seen:
+        return "no moov box (recording not finalized?)"
+    return None
+
+def _check_riff(f, size):
+    """Walk AVI RIFF chunks (OpenDML files have several); they must tile the file"""
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'AVI ':
+        return "missing AVI RIFF header"
+    offset = 0
+    while offset < size:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8 or header[:4] != b'RIFF':
+            return f"bad RIFF chunk at offset {offset}"
+        chunk_size = struct.unpack('<I', header[4:8])[0]
+        offset += 8 + chunk_size + (chunk_size & 1)
+    if offset > size:
+        return "RIFF chunk runs past the end of the file (truncated?)"
+    return None
+
+class BackupCatalog:
+    """SQLite index of every backed up file"""
+
+    COMMIT_EVERY = 200  # Batch inserts - one commit per file is slow on large runs
+
+    def __init__(self, backup_dir, device='unknown'):
+        self.backup_dir = backup_dir
+        self.device = device
+        catalog_dir = os.path.join(backup_dir, CATALOG_DIR_NAME)
+        os.makedirs(catalog_dir, exist_ok=True)
+        self.db_path = os.path.join(catalog_dir, 'catalog.db')
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.pending = 0
+        self._create_schema()
+
+    def _create_schema(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                device TEXT NOT NULL,
+                source_path TEXT NOT NULL,
+                source_folder TEXT NOT NULL,
+                source_name TEXT NOT NULL COLLATE NOCASE,
+                dest_path TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                file_date TEXT NOT NULL,
+                backed_up_at TEXT NOT NULL,
+                fingerprint TEXT,
+                full_hash TEXT,
+                integrity_error TEXT,
+                device_mtime INTEGER,
+                UNIQUE (device, source_path)
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_date ON files (file_date);
+            CREATE INDEX IF NOT EXISTS idx_files_type_date ON files (media_type, file_date);
+            CREATE INDEX IF NOT EXISTS idx_files_source ON files (source_name, file_date);
+            CREATE INDEX IF NOT EXISTS idx_files_device ON files (device, file_date);
+            CREATE INDEX IF NOT EXISTS idx_files_size ON files (size);
+            CREATE INDEX IF NOT EXISTS idx_files_dest ON files (dest_path);
+        """)
+        # Catalogs created before duplicate detection lack the hash, integrity and mtime columns
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        for column in ('fingerprint', 'full_hash', 'integrity_error'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        if 'device_mtime' not in columns:
+            self.conn.execute("ALTER TABLE files ADD COLUMN device_mtime INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_files_fingerprint ON files (fingerprint)")
+        # Version 1: source_name was the scanned folder, not the folder holding the file
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            updates = []
+            for row_id, source_path, source_folder, old_name in self.conn.execute(
+                    "SELECT id, source_path, source_folder, source_name FROM files").fetchall():
+                source_name = source_name_for(source_path, source_folder)
+                if source_name != old_name:
+                    updates.append((source_name, row_id))
+            self.conn.executemany("UPDATE files SET source_name = ? WHERE id = ?", updates)
+            self.conn.execute("PRAGMA user_version = 1")
+        # Timings of past backups, used by BackupSession.plan() to estimate durations
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                device TEXT NOT NULL,
+                source_folder TEXT NOT NULL,
+                files INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                finished_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_runs_device_folder ON runs (device, source_folder);
+            CREATE TABLE IF NOT EXISTS retries (
+                device TEXT NOT NULL,
+                source_path TEXT NOT NULL,
+                source_folder TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                PRIMARY KEY (device, source_path)
+            );
+        """)
+        # Runs recorded before these columns counted skipped files as pulled; they are not used
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(runs)")}
+        for column, column_type in (('checked_files', 'INTEGER'), ('check_seconds', 'REAL'),
+                                    ('pulled_files', 'INTEGER')):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE runs ADD COLUMN {column} {column_type}")
+        self.conn.commit()
+
+    def record(self, source_path, dest_path, source_folder, fingerprint=None, full_hash=None,
+               integrity_error=None, device_mtime=None):
+        """Add (or refresh) the entry for a backed up file
+
+        integrity_error marks a copy that was kept although it failed
+        check_media_integrity. device_mtime is the file's modification time
+        on the device, which lets later runs skip it unchanged.
+        """
+        try:
+            stat = os.stat(dest_path)
+        except OSError:
+            return False
+        self.conn.execute("""
+            INSERT OR REPLACE INTO files
+                (device, source_path, source_folder, source_name, dest_path,
+                 media_type, size, file_date, backed_up_at, fingerprint, full_hash, integrity_error,
+                 device_mtime)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            self.device, source_path, source_folder, source_name_for(source_path, source_folder),
+            os.path.abspath(dest_path), get_media_type(dest_path), stat.st_size,
+            time.strftime('%Y-%m-%d', time.localtime(stat.st_mtime)),
+            time.strftime('%Y-%m-%d %H:%M:%S'), fingerprint, full_hash, integrity_error, device_mtime,
+        ))
+        self._maybe_commit()
+        return True
+
+    def find_candidates(self, fingerprint):
+        """Return (dest_path, full_hash) for backed up files sharing a fingerprint"""
+        return self.conn.execute(
+            "SELECT DISTINCT dest_path, full_hash FROM files WHERE fingerprint = ?", (fingerprint,)).fetchall()
+
+    def find_entry(self, source_path):
+        """Return (size, fingerprint, dest_path, device_mtime) of a device file backed up before, or None"""
+        return self.conn.execute(
+            "SELECT size, fingerprint, dest_path, device_mtime FROM files WHERE device = ? AND source_path = ?",
+            (self.device, source_path)).fetchone()
+
+    def set_device_mtime(self, source_path, device_mtime):
+        """Remember the device modification time of a backed up file"""
+        self.conn.execute("UPDATE files SET device_mtime = ? WHERE device = ? AND source_path = ?",
+                          (device_mtime, self.device, source_path))
+        self._maybe_commit()
+
+    def has_size(self, size):
+        """Check if any backed up file has exactly this size"""
+        return self.conn.execute("SELECT 1 FROM files WHERE size = ? LIMIT 1", (size,)).fetchone() is not None
+
+    def record_run(self, source_folder, files, checked_files, check_seconds, pulled_files, size, seconds):
+        """Remember how long backing up a folder took
+
+        checked_files were fingerprinted on the device in check_seconds;
+        pulled_files (size bytes) were transferred in the rest of seconds.
+        """
+        self.conn.execute("""
+            INSERT INTO runs (device, source_folder, files, checked_files, check_seconds, pulled_files,
+                              bytes, seconds, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.device, source_folder, files, checked_files, check_seconds, pulled_files, size, seconds,
+              time.strftime('%Y-%m-%d %H:%M:%S')))
+        self._maybe_commit()
+
+    def add_retry(self, source_path, source_folder):
+        """Remember a failed transfer so watch mode tries it again"""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO retries (device, source_path, source_folder, attempts) VALUES (?, ?, ?, 0)",
+            (self.device, source_path, source_folder))
+        self.conn.execute("UPDATE retries SET attempts = attempts + 1 WHERE device = ? AND source_path = ?",
+                          (self.device, source_path))
+        self._maybe_commit()
+
+    def remove_retry(self, source_path):
+        self.conn.execute("DELETE FROM retries WHERE device = ? AND source_path = ?", (self.device, source_path))
+        self._maybe_commit()
+
+    def pending_retries(self, max_attempts=WATCH_MAX_ATTEMPTS):
+        """Return (source_path, source_folder) of failed transfers not yet given up"""
+        return self.conn.execute(
+            "SELECT source_path, source_folder FROM retries WHERE device = ? AND attempts < ?",
+            (self.device, max_attempts)).fetchall()
+
+    def throughput_model(self, source_folder):
+        """Return (check_seconds, per_file_seconds, bytes_per_second, runs used) for a device folder
+
+        check_seconds is the time to fingerprint one file; per_file_seconds
+        and bytes_per_second describe pulls. Calibrated on the folder's
+        recent runs, else on the device's, else the defaults are returned
+        with 0 runs used.
+        """
+        for where, params in (("device = ? AND source_folder = ?", (self.device, source_folder)),
+                              ("device = ?", (self.device,))):
+            runs = self.conn.execute(f"""
+                SELECT checked_files, check_seconds, pulled_files, bytes, seconds FROM runs
+                WHERE {where} AND pulled_files IS NOT NULL ORDER BY id DESC LIMIT {PLAN_HISTORY}
+            """, params).fetchall()
+            if runs:
+                checked_files = sum(run[0] for run in runs)
+                check_seconds = DEFAULT_CHECK_SECONDS
+                if checked_files:
+                    check_seconds = sum(run[1] for run in runs) / checked_files
+                # Only runs that pulled something say anything about pulls
+                samples = [(pulled_files, size, seconds - run_check_seconds)
+                           for _, run_check_seconds, pulled_files, size, seconds in runs
+                           if pulled_files and size and seconds > run_check_seconds]
+                return (check_seconds,) + fit_throughput(samples) + (len(runs),)
+        return DEFAULT_CHECK_SECONDS, DEFAULT_FILE_OVERHEAD, DEFAULT_THROUGHPUT, 0
+
+    def set_full_hash(self, dest_path, full_hash):
+        """Remember the full hash of a backed up file"""
+        self.conn.execute("UPDATE files SET full_hash = ? WHERE dest_path = ?", (full_hash, dest_path))
+        self._maybe_commit()
+
+    def update_location(self, old_path, new_path):
+        """Point an entry at the file's new location after it was moved"""
+        self.conn.execute("UPDATE files SET dest_path = ? WHERE dest_path = ?",
+                          (os.path.abspath(new_path), os.path.abspath(old_path)))
+        self._maybe_commit()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def query(self, filters, limit=None):
+        """Return (total matches, rows) for a dict of query filters"""
+        where, params = build_catalog_filter(filters)
+        total = self.conn.execute(f"SELECT COUNT(*) FROM files{where}", params).fetchone()[0]
+        sql = f"SELECT file_date, media_type, source_name, device, size, dest_path FROM files{where} ORDER BY file_date"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return total, self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def fit_throughput(samples):
+    """Fit seconds = files * per_file + bytes / rate to (files, bytes, seconds) pull samples
+
+    Least squares over both terms. When the samples cannot separate them
+    (one run, or runs of identical shape) the whole time is put down to the
+    bytes, i.e. the measured average rate with no per-file term. Returns
+    (per_file_seconds, bytes_per_second); the defaults without samples.
+    """
+    if not samples:
+        return DEFAULT_FILE_OVERHEAD, DEFAULT_THROUGHPUT
+    nn = nb = bb = nt = bt = 0.0
+    for files, size, seconds in samples:
+        nn += files * files
+        nb += files * size
+        bb += size * size
+        nt += files * seconds
+        bt += size * seconds
+    det = nn * bb - nb * nb
+    if det > 1e-9 * nn * bb:
+        per_file = (nt * bb - bt * nb) / det
+        per_byte = (nn * bt - nb * nt) / det
+        if per_file >= 0 and per_byte > 0:
+            return per_file, 1 / per_byte
+    total_bytes = sum(sample[1] for sample in samples)
+    total_seconds = sum(sample[2] for sample in samples)
+    if total_bytes <= 0 or total_seconds <= 0:
+        return DEFAULT_FILE_OVERHEAD, DEFAULT_THROUGHPUT
+    return 0.0, total_bytes / total_seconds
+
+def parse_size(value):
+    """Parse sizes such as '500', '10KB', '2.5MB' or '1GB' into bytes"""
+    value = value.strip().upper()
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024), ('B', 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+def build_catalog_filter(filters):
+    """Turn query filters into an SQL WHERE clause and its parameters"""
+    clauses = []
+    params = []
+    for key, value in filters.items():
+        if key == 'type':
+            media_type = value.lower().rstrip('s')  # Accept 'videos' as well as 'video'
+            clauses.append("media_type = ?")
+            params.append(media_type)
+        elif key == 'source':
+            clauses.append("source_name = ?")
+            params.append(value)
+        elif key == 'device':
+            clauses.append("device = ?")
+            params.append(value)
+        elif key == 'date':
+            # Prefix match as a range so the date index is used: 2024, 2024-03, 2024-03-15
+            clauses.append("file_date >= ? AND file_date < ?")
+            params.extend([value, value + '~'])
+        elif key == 'from':
+            clauses.append("file_date >= ?")
+            params.append(value)
+        elif key == 'to':
+            clauses.append("file_date <= ?")
+            params.append(value)
+        elif key == 'min_size':
+            clauses.append("size >= ?")
+            params.append(parse_size(value))
+        elif key == 'max_size':
+            clauses.append("size <= ?")
+            params.append(parse_size(value))
+        else:
+            raise ValueError(f"Unknown query field: {key}")
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return where, params
+
+def parse_query(query):
+    """Parse 'type=video source=TikTok date=2024-03' into a dict of filters"""
+    filters = {}
+    for term in query.split():
+        if '=' not in term:
+            raise ValueError(f"Invalid query term '{term}' (expected field=value)")
+        key, value = term.split('=', 1)
+        filters[key.strip().lower().replace('-', '_')] = value.strip()
+    return filters
+
+# Trace lane (pid, tid) of the current task - asyncio tasks inherit it on creation
+_trace_lane = contextvars.ContextVar('media_vault_trace_lane', default=(0, 0))
+
+class Tracer:
+    """Records timed spans and saves them in Chrome trace format
+
+    The JSON opens in chrome://tracing, ui.perfetto.dev and speedscope.
+    Spans are laid out in lanes: each backed up folder is a "process" whose
+    "threads" are the folder itself and its transfer workers.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.perf_counter()
+        self.named_lanes = set()
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6  # Microseconds
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block as a span in the current lane"""
+        start = self._now()
+        try:
+            yield
+        finally:
+            pid, tid = _trace_lane.get()
+            event = {'name': name, 'ph': 'X', 'ts': start, 'dur': self._now() - start, 'pid': pid, 'tid': tid}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def lane(self, pid, tid, process_name=None, thread_name=None):
+        """Record spans of the enclosed block (and tasks it starts) in lane pid/tid"""
+        if process_name and (pid, None) not in self.named_lanes:
+            self.named_lanes.add((pid, None))
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': process_name}})
+        if thread_name and (pid, tid) not in self.named_lanes:
+            self.named_lanes.add((pid, tid))
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                                'args': {'name': thread_name}})
+        token = _trace_lane.set((pid, tid))
+        try:
+            yield
+        finally:
+            _trace_lane.reset(token)
+
+    def counter(self, name, value):
+        """Record the value of a counter (shown as a graph in the trace viewer)"""
+        self.events.append({'name': name, 'ph': 'C', 'ts': self._now(), 'pid': 0, 'args': {name: value}})
+
+    def save(self, path):
+        """Write the trace as Chrome trace JSON"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+def trace_span(tracer, name, **args):
+    """tracer.span(), or a no-op when tracing is off"""
+    return tracer.span(name, **args) if tracer else contextlib.nullcontext()
+
+def trace_lane(tracer, pid, tid, process_name=None, thread_name=None):
+    """tracer.lane(), or a no-op when tracing is off"""
+    return tracer.lane(pid, tid, process_name, thread_name) if tracer else contextlib.nullcontext()
+
+async def run_adb(adb_path, args, input=None, timeout=None, tracer=None):
+    """Run an adb command and return (returncode, stdout, stderr)
+
+    The adb process is killed if the timeout expires (asyncio.TimeoutError
+    is raised) or the calling task is cancelled.
+    """
+    with trace_span(tracer, 'adb spawn'):
+        process = await asyncio.create_subprocess_exec(
+            adb_path, *args,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+    try:
+        with trace_span(tracer, f'adb {args[0]}', command=' '.join(args)[:200]):
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(input.encode('utf-8') if input is not None else None), timeout)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+class DeviceFile:
+    """A media file found on the device"""
+    __slots__ = ('path', 'size', 'mtime', 'folder')
+
+    def __init__(self, path, size, mtime, folder):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.folder = folder
+
+    def __repr__(self):
+        return f"DeviceFile({self.path!r}, {self.size})"
+
+class PathStore:
+    """Compact append-only list of device paths
+
+    Each directory is stored once and file names are packed into a single
+    buffer, so a million paths take tens of megabytes rather than hundreds.
+    Supports len(), iteration and indexing like a list of strings.
+    """
+
+    def __init__(self, paths=()):
+        self._dirs = []  # Distinct directory prefixes, including the trailing /
+        self._dir_index = {}  # directory prefix -> index in _dirs
+        self._entry_dirs = array('I')
+        self._name_ends = array('Q')  # End offset of each name in _names
+        self._names = bytearray()
+        self.extend(paths)
+
+    def append(self, path):
+        directory, sep, name = path.rpartition('/')
+        directory += sep
+        index = self._dir_index.get(directory)
+        if index is None:
+            index = self._dir_index[directory] = len(self._dirs)
+            self._dirs.append(directory)
+        self._entry_dirs.append(index)
+        self._names += name.encode('utf-8', 'surrogateescape')
+        self._name_ends.append(len(self._names))
+
+    def extend(self, paths):
+        for path in paths:
+            self.append(path)
+
+    def __len__(self):
+        return len(self._entry_dirs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._path(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PathStore index out of range")
+        return self._path(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._path(index)
+
+    def __repr__(self):
+        return f"PathStore({len(self)} paths)"
+
+    def _path(self, index):
+        start = self._name_ends[index - 1] if index else 0
+        name = self._names[start:self._name_ends[index]].decode('utf-8', 'surrogateescape')
+        return self._dirs[self._entry_dirs[index]] + name
+
+class DeviceFileList:
+    """Compact list of the media files found in one device folder
+
+    Sizes and timestamps are kept in arrays next to a PathStore; DeviceFile
+    objects are only created while iterating.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.paths = PathStore()
+        self.sizes = array('q')
+        self.mtimes = array('q')
+
+    def append(self, path, size, mtime):
+        self.paths.append(path)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        return DeviceFile(self.paths[index], self.sizes[index], self.mtimes[index], self.folder)
+
+    def __iter__(self):
+        for index, path in enumerate(self.paths):
+            yield DeviceFile(path, self.sizes[index], self.mtimes[index], self.folder)
+
+class FingerprintTable:
+    """Device fingerprints of a DeviceFileList, stored by file index"""
+
+    def __init__(self, count):
+        self._sizes = array('q', [-1]) * count  # -1: not fingerprinted
+        self._digests = bytearray(16 * count)
+
+    def set(self, index, size, digest):
+        self._sizes[index] = size
+        self._digests[16 * index:16 * index + 16] = bytes.fromhex(digest)
+
+    def get(self, index):
+        """Return the fingerprint of a file ("size:md5 of its first and last 64 KB"), or None"""
+        size = self._sizes[index]
+        if size < 0:
+            return None
+        return f"{size}:{self._digests[16 * index:16 * index + 16].hex()}"
+
+class FolderInventory:
+    """The media files found in one device folder"""
+
+    def __init__(self, folder, files, error=None):
+        self.folder = folder
+        self.files = files  # DeviceFileList
+        self.total_size = sum(files.sizes)
+        self.error = error  # Set when the folder could not be listed
+
+class AdaptiveLimiter:
+    """Limits concurrent transfers, adjusting the limit by AIMD
+
+    Throughput is measured over windows of `window` seconds. After a window
+    without errors in which every slot was busy, the limit grows by one if
+    throughput improved; if growing brought no gain it steps back by one.
+    A failed or timed out transfer halves the limit (at most once per
+    window), so a struggling device or cable is backed off quickly.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=8, window=5.0, on_change=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+        self.on_change = on_change
+        self.in_flight = 0
+        self._condition = None
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_saturated = False
+        self._last_throughput = None
+        self._last_change = None
+        self._last_decrease = 0
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            while self.in_flight >= self.limit:
+                await self._condition.wait()
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._window_saturated = True
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record_success(self, size):
+        self._window_bytes += size
+        self._maybe_adjust()
+
+    def record_failure(self):
+        self._window_errors += 1
+        now = time.monotonic()
+        if self.limit > self.minimum and now - self._last_decrease >= self.window:
+            self._last_decrease = now
+            self._last_change = 'down'
+            self._set_limit(max(self.minimum, self.limit // 2))
+        self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        throughput = self._window_bytes / elapsed
+        if not self._window_errors:
+            improved = self._last_throughput is None or throughput > self._last_throughput * 1.05
+            worse = self._last_throughput is not None and throughput < self._last_throughput * 0.95
+            if improved and self._window_saturated and self.limit < self.maximum:
+                self._last_change = 'up'
+                self._set_limit(self.limit + 1)
+            elif worse and self._last_change == 'up' and self.limit > self.minimum:
+                # The extra transfer did not help - give it back
+                self._last_change = 'down'
+                self._set_limit(self.limit - 1)
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_saturated = self.in_flight >= self.limit
+
+    def _set_limit(self, limit):
+        if limit == self.limit:
+            return
+        raised = limit > self.limit
+        self.limit = limit
+        if raised and self._condition is not None:
+            # Wake waiting transfers so the new slot is used right away
+            asyncio.ensure_future(self._notify())
+        if self.on_change:
+            self.on_change(limit)
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+class DestinationShards:
+    """Chooses which destination root each backed up file is written to
+
+    round-robin: files alternate between the roots
+    free-space: bytes are spread in proportion to each root's free space
+    by-folder: all files of a device folder go to the same root
+    """
+
+    def __init__(self, roots, policy='round-robin'):
+        if not roots:
+            raise ValueError("At least one destination root is required")
+        if policy not in SHARD_POLICIES:
+            raise ValueError(f"Unknown shard policy: {policy}")
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.policy = policy
+        self.assigned = {root: 0 for root in self.roots}  # Bytes sent to each root this run
+        self.free = {}
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+            self.free[root] = shutil.disk_usage(root).free
+        self._next = 0
+
+    def folder_root(self, folder):
+        """Return the root all files of a device folder go to under the by-folder policy"""
+        # crc32 is stable across runs, so a folder keeps landing on the same disk
+        return self.roots[zlib.crc32(folder.encode('utf-8')) % len(self.roots)]
+
+    def choose(self, device_file):
+        """Return the root a device file should be written to"""
+        if len(self.roots) == 1:
+            root = self.roots[0]
+        elif self.policy == 'round-robin':
+            root = self.roots[self._next % len(self.roots)]
+            self._next += 1
+        elif self.policy == 'by-folder':
+            root = self.folder_root(device_file.folder)
+        else:
+            fits = [r for r in self.roots if self.free[r] - self.assigned[r] > device_file.size]
+            root = min(fits or self.roots, key=lambda r: self.assigned[r] / max(self.free[r], 1))
+        self.assigned[root] += device_file.size
+        return root
+
+class MirrorReplicator:
+    """Copies files added by a backup to one or more secondary roots
+
+    Each file keeps its path relative to the destination root it was
+    written to. Copies run on a thread pool (see copy_file_fast) while the
+    backup continues, and a copy only counts once its size matches.
+    """
+
+    def __init__(self, roots, workers_per_root=MIRROR_WORKERS):
+        if not roots:
+            raise ValueError("At least one mirror root is required")
+        self.roots = [os.path.abspath(root) for root in roots]
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max(1, workers_per_root * len(self.roots)))
+        self.copied = 0
+        self.copied_bytes = 0
+        self.failed = 0
+        self.methods = {}  # Copy method -> number of files
+        self._lock = threading.Lock()  # Counters are updated from the pool threads
+
+    def replicate(self, path, source_root):
+        """Copy one file to every mirror root; returns a list of errors"""
+        relative_path = os.path.relpath(path, source_root)
+        errors = []
+        for root in self.roots:
+            target = os.path.join(root, relative_path)
+            temp_path = target + PARTIAL_SUFFIX
+            try:
+                size = os.path.getsize(path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                method = copy_file_fast(path, temp_path)
+                copied_size = os.path.getsize(temp_path)
+                if copied_size != size:
+                    raise OSError(f"size mismatch: {copied_size} of {size} bytes copied")
+                shutil.copystat(path, temp_path)
+                os.replace(temp_path, target)
+            except OSError as e:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_path)
+                errors.append(f"{target}: {e}")
+                continue
+            with self._lock:
+                self.copied += 1
+                self.copied_bytes += size
+                self.methods[method] = self.methods.get(method, 0) + 1
+        with self._lock:
+            self.failed += len(errors)
+        return errors
+
+    def close(self):
+        self.executor.shutdown()
+
+class BackupEvent:
+    """Progress event yielded by BackupSession.events()
+
+    kind is one of: folder_started, folder_done, folder_failed, file_started,
+    file_done, file_failed, file_skipped, file_retry, device_disconnected,
+    concurrency_changed (count is the new limit), file_mirrored,
+    mirror_failed. A file_done event with error set is a copy that was kept
+    although it failed the integrity check; it is not removed by cleanup.
+    """
+    __slots__ = ('kind', 'folder', 'path', 'dest_path', 'size', 'count', 'attempt', 'error', 'timestamp')
+
+    def __init__(self, kind, folder=None, path=None, dest_path=None, size=0, count=0, attempt=0, error=None):
+        self.kind = kind
+        self.folder = folder
+        self.path = path
+        self.dest_path = dest_path
+        self.size = size
+        self.count = count
+        self.attempt = attempt
+        self.error = error
+        self.timestamp = time.time()
+
+    def __repr__(self):
+        return f"BackupEvent({self.kind!r}, path={self.path!r})"
+
+class BackupResult:
+    """Outcome of BackupSession.run()"""
+
+    def __init__(self, successful_files, failed_files, duplicates_skipped, cancelled, failed_folders=(),
+                 suspect_files=None, already_backed_up=0):
+        self.successful_files = successful_files
+        self.failed_files = failed_files
+        self.already_backed_up = already_backed_up  # Skipped: backed up before from the same path
+        self.suspect_files = suspect_files if suspect_files is not None else PathStore()
+        self.failed_folders = list(failed_folders)
+        self.duplicates_skipped = duplicates_skipped
+        self.cancelled = cancelled
+
+class FolderPlan:
+    """What BackupSession.run() would do with one device folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.new = PathStore()
+        self.duplicates = PathStore()  # Same fingerprint as a backed up or another new file
+        self.backed_up = PathStore()  # This device path was backed up before, unchanged
+        self.new_bytes = 0
+        self.total_files = 0
+        self.checked_files = 0  # Files run() would fingerprint - all but the unchanged ones
+        self.check_seconds = DEFAULT_CHECK_SECONDS
+        self.per_file_seconds = DEFAULT_FILE_OVERHEAD
+        self.bytes_per_second = DEFAULT_THROUGHPUT
+        self.calibration_runs = 0
+        self.error = None  # Set when the folder could not be listed
+
+    @property
+    def estimated_seconds(self):
+        # Changed files are fingerprinted; only new files are pulled
+        return (self.checked_files * self.check_seconds + len(self.new) * self.per_file_seconds
+                + self.new_bytes / self.bytes_per_second)
+
+class BackupPlan:
+    """Outcome of BackupSession.plan()"""
+
+    def __init__(self, folders):
+        self.folders = folders  # List of FolderPlan
+
+    @property
+    def estimated_seconds(self):
+        return sum(folder.estimated_seconds for folder in self.folders)
+
+class BackupSession:
+    """Back up media folders from a connected device
+
+    All device access goes through async adb subprocesses, so a session can
+    run inside any asyncio application. The number of pulls in flight is
+    adjusted at runtime (see AdaptiveLimiter) between 1 and
+    max_concurrent_transfers per destination root; with several roots (see
+    DestinationShards) each disk is written in parallel. Pass
+    adaptive=False to always run max_concurrent_transfers pulls.
+
+    Folders are backed up one after another, except under the by-folder
+    policy, where folders going to different roots run side by side so
+    every disk is written at once. Each pull may take `timeout` seconds
+    plus its size at MIN_PULL_THROUGHPUT, so large videos sharing the link
+    are not cut off. With a MirrorReplicator, every pulled file is also
+    copied to the mirror roots while the backup goes on; run() returns once
+    those copies are done.
+    """
+
+    def __init__(self, adb_path: str, backup_dir: str, folders: Optional[List[str]] = None,
+                 catalog: Optional[BackupCatalog] = None, max_concurrent_transfers: int = 8,
+                 initial_concurrent_transfers: int = 2, adaptive: bool = True,
+                 retries: int = 3, timeout: float = 300, failure_log: Optional[str] = None,
+                 tracer: Optional[Tracer] = None, shards: Optional[DestinationShards] = None,
+                 mirror: Optional[MirrorReplicator] = None):
+        self.adb_path = adb_path
+        self.backup_dir = backup_dir
+        self.folders = list(folders) if folders is not None else list(DEVICE_FOLDERS)
+        self.catalog = catalog
+        self.max_concurrent_transfers = max(1, max_concurrent_transfers)
+        self.initial_concurrent_transfers = initial_concurrent_transfers
+        self.adaptive = adaptive
+        self.limiter = None  # type: Optional[AdaptiveLimiter]
+        self.retries = retries
+        self.timeout = timeout
+        self.failure_log = failure_log
+        self.tracer = tracer
+        self.shards = shards or DestinationShards([backup_dir])
+        self.mirror = mirror
+        self.newer_than = None  # Device file - when set, only newer files are scanned
+
+        self.folder_inventory = {}  # type: Dict[str, FolderInventory]
+        self.successful_files = PathStore()
+        self.failed_files = PathStore()
+        self.suspect_files = PathStore()  # Kept although they failed the integrity check
+        self.failed_folders = []  # Folders that could not be listed or backed up
+        self.duplicates_skipped = 0
+        self.already_backed_up = 0
+
+        self._queue = None
+        self._workers = set()
+        self._mirror_tasks = set()
+        self._inflight = {}  # fingerprint -> asyncio.Event for pulls in progress
+        self._root_slots = {}  # root -> asyncio.Semaphore limiting pulls per disk
+        self._created_dirs = set()
+        self._claimed_dests = set()  # Destination paths of the pulls in progress
+        self._partial_files = set()  # Files being written by running pulls
+        self._pulled = {}  # folder -> (files, bytes) pulled by the current run of the folder
+        self._cancelled = False
+        self._stop = None  # Set by cancel() to wake idle sleeps
+
+    # Events
+
+    def events(self):
+        """Return an async iterator over progress events of the next run()
+
+        Call this before starting run() so no events are missed. Iteration
+        ends when run() finishes.
+        """
+        self._queue = asyncio.Queue()
+        return self._iter_events(self._queue)
+
+    async def _iter_events(self, queue):
+        while True:
+            event = await queue.get()
+            if event is None:
+                return
+            yield event
+
+    def _emit(self, kind, **fields):
+        if self._queue is not None:
+            self._queue.put_nowait(BackupEvent(kind, **fields))
+
+    # Device helpers
+
+    async def adb(self, *args, input=None, timeout=None):
+        """Run an adb command for this session"""
+        return await run_adb(self.adb_path, args, input=input, timeout=timeout, tracer=self.tracer)
+
+    async def wait_for_device(self, poll_interval: float = 1):
+        """Wait until a device is connected; returns False if cancelled"""
+        while not self._cancelled:
+            try:
+                _, stdout, _ = await self.adb('devices', timeout=30)
+                lines = stdout.split('\n')[1:]
+                if any(line.strip().endswith('\tdevice') for line in lines):
+                    return True
+            except (OSError, asyncio.TimeoutError):
+                pass
+            await self._sleep(poll_interval)
+        return False
+
+    async def _sleep(self, seconds):
+        """Sleep, waking early if cancel() is called"""
+        if self._stop is None:
+            self._stop = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def get_device_serial(self) -> str:
+        """Return the serial number of the connected device"""
+        try:
+            returncode, stdout, _ = await self.adb('get-serialno', timeout=30)
+            serial = stdout.strip()
+            if returncode == 0 and serial and serial != 'unknown':
+                return serial
+        except (OSError, asyncio.TimeoutError):
+            pass
+        return 'unknown'
+
+    async def _shell_batches(self, script, paths, timeout=600):
+        """Run a shell loop over paths fed on stdin, SHELL_BATCH_SIZE at a time
+
+        Paths go through stdin so names with spaces or quotes need no escaping.
+        Yields (batch, stdout) for each batch; stdout is None if adb failed.
+        """
+        paths = iter(paths)
+        while True:
+            batch = list(itertools.islice(paths, SHELL_BATCH_SIZE))
+            if not batch:
+                return
+            try:
+                _, stdout, _ = await self.adb('shell', script, input='\n'.join(batch) + '\n', timeout=timeout)
+            except (OSError, asyncio.TimeoutError):
+                stdout = None
+            yield batch, stdout
+
+    # Inventory
+
+    async def inventory(self):
+        """Scan the session's folders, yielding a FolderInventory for each"""
+        for folder in self.folders:
+            folder_inventory = await self.scan_folder(folder)
+            self.folder_inventory[folder] = folder_inventory
+            yield folder_inventory
+
+    async def scan_folder(self, folder: str) -> FolderInventory:
+        """List the media files under a device folder (or a single file path)"""
+        newer = f'-newer "{self.newer_than}" ' if self.newer_than else ''
+        files = DeviceFileList(folder)
+        # One find call returns size, mtime and path for every file
+        try:
+            with trace_span(self.tracer, 'scan', folder=folder):
+                _, stdout, _ = await self.adb(
+                    'shell', f'find "{folder}" -type f {newer}-exec stat -c "%s %Y %n" {{}} + 2>/dev/null', timeout=600)
+        except (OSError, asyncio.TimeoutError) as e:
+            error = str(e) or "Timeout"
+            self._log_failure(f"Error scanning folder {folder}: {error}")
+            self._emit('folder_failed', folder=folder, error=error)
+            return FolderInventory(folder, files, error)
+        for line in stdout.splitlines():
+            parts = line.rstrip('\r').split(' ', 2)
+            if len(parts) == 3 and parts[0].isdigit() and is_media_file(parts[2]):
+                files.append(parts[2], int(parts[0]), int(parts[1]) if parts[1].isdigit() else 0)
+        return FolderInventory(folder, files)
+
+    async def _fingerprint_paths(self, paths):
+        """Yield (index, size, md5 hex) for each device file fingerprinted
+
+        The shell loop reports line numbers instead of echoing paths back, so
+        results can be stored by index without a path lookup table.
+        """
+        script = ('i=0; while IFS= read -r f; do i=$((i+1)); '
+                  's=$(stat -c %s "$f") && '
+                  f'h=$({{ head -c {FINGERPRINT_CHUNK} "$f"; tail -c {FINGERPRINT_CHUNK} "$f"; }} | md5sum) && '
+                  'echo "$i $s ${h%% *}"; '
+                  'done')
+        offset = 0
+        async for batch, stdout in self._shell_batches(script, paths):
+            for line in (stdout or '').splitlines():
+                parts = line.rstrip('\r').split(' ')
+                if len(parts) == 3 and parts[0].isdigit() and parts[1].isdigit() and len(parts[2]) == 32:
+                    index = int(parts[0]) - 1
+                    if 0 <= index < len(batch):
+                        yield offset + index, int(parts[1]), parts[2]
+            offset += len(batch)
+
+    async def get_device_md5(self, path: str) -> Optional[str]:
+        """Return the full MD5 of a device file, or None"""
+        try:
+            returncode, stdout, _ = await self.adb('shell', f'md5sum "{path}"', timeout=600)
+            if returncode == 0 and stdout.strip():
+                return stdout.split()[0]
+        except (OSError, asyncio.TimeoutError):
+            pass
+        return None
+
+    # Planning
+
+    async def plan(self) -> BackupPlan:
+        """Work out what run() would do and how long it would take
+
+        Only the inventory is taken; nothing is pulled. Files are sorted
+        with the same rules as run() (see _classify): backed up, duplicate
+        or new. Duplicates are matched by fingerprint only; the full hash
+        run() compares is not computed. Files backed up before with the same
+        size and device mtime are not fingerprinted, and neither are files
+        whose size occurs neither in the catalog nor twice on the device -
+        they cannot match anything - so planning a rerun takes no device work
+        beyond the inventory. Durations come from the catalog's throughput
+        model.
+        """
+        if not self.catalog:
+            raise ValueError("Planning needs a catalog")
+        if self.catalog.device == 'unknown':
+            self.catalog.device = await self.get_device_serial()
+        with trace_span(self.tracer, 'plan'):
+            pending = []  # (FolderPlan, DeviceFileList)
+            sizes = array('q')
+            for folder in self.folders:
+                folder_inventory = self.folder_inventory.get(folder)
+                if folder_inventory is None or folder_inventory.error:
+                    folder_inventory = self.folder_inventory[folder] = await self.scan_folder(folder)
+                folder_plan = FolderPlan(folder)
+                folder_plan.error = folder_inventory.error
+                folder_plan.total_files = len(folder_inventory.files)
+                (folder_plan.check_seconds, folder_plan.per_file_seconds, folder_plan.bytes_per_second,
+                 folder_plan.calibration_runs) = self.catalog.throughput_model(folder)
+                sizes.extend(folder_inventory.files.sizes)
+                pending.append((folder_plan, folder_inventory.files))
+            sizes = array('q', sorted(sizes))
+
+            def may_match(size):
+                position = bisect.bisect_left(sizes, size)
+                shared = position + 1 < len(sizes) and sizes[position + 1] == size
+                return shared or self.catalog.has_size(size)
+
+            seen = set()  # Fingerprints of the new files so far
+            for folder_plan, files in pending:
+                unchanged = bytearray(len(files))
+                candidates = array('I')
+                for index, path in enumerate(files.paths):
+                    if self._backed_up_copy(path, files.sizes[index], files.mtimes[index]):
+                        unchanged[index] = 1
+                    elif may_match(files.sizes[index]):
+                        candidates.append(index)
+                folder_plan.checked_files = len(files) - sum(unchanged)
+                fingerprints = FingerprintTable(len(files))
+                with trace_span(self.tracer, 'fingerprint', files=len(candidates)):
+                    async for position, size, digest in self._fingerprint_paths(
+                            files.paths[index] for index in candidates):
+                        fingerprints.set(candidates[position], size, digest)
+                for index, path in enumerate(files.paths):
+                    fingerprint = fingerprints.get(index)
+                    status = 'new'
+                    if unchanged[index]:
+                        status = 'backed_up'
+                    elif fingerprint:
+                        if fingerprint in seen:
+                            status = 'duplicate'
+                        else:
+                            status, _ = await self._classify(path, files.sizes[index], files.mtimes[index],
+                                                             fingerprint, confirm=False)
+                    if status == 'backed_up':
+                        folder_plan.backed_up.append(path)
+                    elif status == 'duplicate':
+                        folder_plan.duplicates.append(path)
+                    else:
+                        if fingerprint:
+                            seen.add(fingerprint)
+                        folder_plan.new.append(path)
+                        folder_plan.new_bytes += files.sizes[index]
+        return BackupPlan([folder_plan for folder_plan, _ in pending])
+
+    # Backup
+
+    def cancel(self):
+        """Stop the running backup; transfers in flight are aborted"""
+        self._cancelled = True
+        if self._stop is not None:
+            self._stop.set()
+        for task in list(self._workers) + list(self._mirror_tasks):
+            task.cancel()
+
+    async def run(self) -> BackupResult:
+        """Back up every folder of the session
+
+        Folders that were not scanned with inventory() are scanned first.
+        """
+        self._cancelled = False
+        self._stop = None
+        self._root_slots = {root: asyncio.Semaphore(self.max_concurrent_transfers) for root in self.shards.roots}
+        maximum = self.max_concurrent_transfers * len(self.shards.roots)
+        if self.adaptive:
+            self.limiter = AdaptiveLimiter(self.initial_concurrent_transfers, 1, maximum,
+                                           on_change=self._concurrency_changed)
+        else:
+            self.limiter = AdaptiveLimiter(maximum, maximum, maximum)
+        try:
+            with trace_span(self.tracer, 'backup'):
+                if self.catalog and self.catalog.device == 'unknown':
+                    self.catalog.device = await self.get_device_serial()
+                folders = list(enumerate(self.folders, 1))
+                if self.shards.policy == 'by-folder' and len(self.shards.roots) > 1:
+                    # Each folder writes to a single disk - keep one folder per disk going
+                    by_root = {}
+                    for folder_number, folder in folders:
+                        by_root.setdefault(self.shards.folder_root(folder), []).append((folder_number, folder))
+                    await asyncio.gather(*(self._backup_folders(group) for group in by_root.values()))
+                else:
+                    await self._backup_folders(folders)
+                if self._mirror_tasks and not self._cancelled:
+                    with trace_span(self.tracer, 'mirror', files=len(self._mirror_tasks)):
+                        await asyncio.gather(*self._mirror_tasks)
+        except asyncio.CancelledError:
+            # Only swallow cancellation requested through cancel()
+            if not self._cancelled:
+                raise
+        finally:
+            for mirror_task in list(self._mirror_tasks):
+                mirror_task.cancel()
+            if self.catalog:
+                self.catalog.commit()
+            if self._queue is not None:
+                self._queue.put_nowait(None)
+        return BackupResult(self.successful_files, self.failed_files, self.duplicates_skipped, self._cancelled,
+                            self.failed_folders, self.suspect_files, self.already_backed_up)
+
+    async def _backup_folders(self, folders):
+        """Back up (number, folder) pairs one after another"""
+        for folder_number, folder in folders:
+            if self._cancelled:
+                break
+            folder_inventory = self.folder_inventory.get(folder)
+            if folder_inventory is None or folder_inventory.error:
+                folder_inventory = await self.scan_folder(folder)
+                self.folder_inventory[folder] = folder_inventory
+            if folder_inventory.error:
+                self.failed_folders.append(folder)
+                continue
+            with trace_lane(self.tracer, folder_number, 0, folder, 'folder'):
+                await self._backup_folder(folder_inventory)
+
+    async def _backup_folder(self, folder_inventory):
+        folder = folder_inventory.folder
+        started = time.monotonic()
+        self._pulled[folder] = (0, 0)
+        candidates = ()
+        dest_root = self.shards.folder_root(folder) if self.shards.policy == 'by-folder' else self.backup_dir
+        dest_folder = os.path.join(dest_root, os.path.basename(folder))
+        self._emit('folder_started', folder=folder, dest_path=dest_folder,
+                   size=folder_inventory.total_size, count=len(folder_inventory.files))
+        try:
+            # Fingerprint on the device so duplicates are skipped before any bytes are pulled
+            files = folder_inventory.files
+            fingerprints = FingerprintTable(len(files))
+            if self.catalog:
+                # Files unchanged since they were backed up need no fingerprint
+                candidates = array('I', (index for index, path in enumerate(files.paths)
+                                         if not self._backed_up_copy(path, files.sizes[index], files.mtimes[index])))
+                with trace_span(self.tracer, 'fingerprint', files=len(candidates)):
+                    async for position, size, digest in self._fingerprint_paths(
+                            files.paths[index] for index in candidates):
+                        fingerprints.set(candidates[position], size, digest)
+            check_seconds = time.monotonic() - started
+
+            pending = enumerate(folder_inventory.files)
+            folder_pid = _trace_lane.get()[0]
+
+            async def worker(worker_number):
+                with trace_lane(self.tracer, folder_pid, worker_number, thread_name=f'transfer {worker_number}'):
+                    for index, device_file in pending:
+                        with trace_span(self.tracer, os.path.basename(device_file.path), size=device_file.size):
+                            await self._backup_file(device_file, fingerprints.get(index))
+
+            worker_count = self.max_concurrent_transfers * len(self.shards.roots)
+            workers = [asyncio.ensure_future(worker(n)) for n in range(1, worker_count + 1)]
+            self._workers.update(workers)
+            try:
+                with trace_span(self.tracer, 'transfer', files=len(folder_inventory.files)):
+                    await asyncio.gather(*workers)
+            finally:
+                self._workers.difference_update(workers)
+                for worker_task in workers:
+                    worker_task.cancel()
+        except (OSError, sqlite3.Error) as e:
+            self._log_failure(f"Error processing folder {folder}: {str(e)}")
+            self.failed_folders.append(folder)
+            self._emit('folder_failed', folder=folder, error=str(e))
+            return False
+
+        pulled_files, pulled_bytes = self._pulled.pop(folder)
+        if self.catalog and (candidates or pulled_files) and not self._cancelled:
+            # Calibrates the duration estimates of plan()
+            self.catalog.record_run(folder, len(folder_inventory.files), len(candidates), check_seconds,
+                                    pulled_files, pulled_bytes, time.monotonic() - started)
+        self._emit('folder_done', folder=folder)
+        return True
+
+    async def _backup_file(self, device_file, fingerprint):
+        source_path = device_file.path
+        self._emit('file_started', folder=device_file.folder, path=source_path, size=device_file.size)
+
+        done = None
+        if self.catalog:
+            # An identical file may be in flight on another worker - wait for it first
+            while fingerprint and fingerprint in self._inflight:
+                await self._inflight[fingerprint].wait()
+            with trace_span(self.tracer, 'duplicate check'):
+                status, existing_copy = await self._classify(source_path, device_file.size, device_file.mtime,
+                                                             fingerprint)
+            if status == 'backed_up':
+                self.already_backed_up += 1
+                self._emit('file_skipped', folder=device_file.folder, path=source_path,
+                           dest_path=existing_copy, size=device_file.size)
+                return
+            if status == 'duplicate':
+                with trace_span(self.tracer, 'catalog'):
+                    self.catalog.record(source_path, existing_copy, device_file.folder, fingerprint,
+                                        device_mtime=device_file.mtime)
+                self.duplicates_skipped += 1
+                self._emit('file_skipped', folder=device_file.folder, path=source_path,
+                           dest_path=existing_copy, size=device_file.size)
+                return
+            if fingerprint:
+                done = self._inflight[fingerprint] = asyncio.Event()
+
+        root = self.shards.choose(device_file)
+        dest_folder = os.path.join(root, os.path.basename(device_file.folder))
+        dest_path = self._claim_dest(dest_folder, source_path)
+        try:
+            if dest_folder not in self._created_dirs:
+                os.makedirs(dest_folder, exist_ok=True)
+                self._created_dirs.add(dest_folder)
+            success, error = await self._pull(source_path, dest_path, root, device_file.size)
+            if success:
+                if error:
+                    # The device's own copy is malformed - keep ours, but never delete the original
+                    self.suspect_files.append(source_path)
+                    self._log_failure(f"Kept despite failed integrity check: {source_path}\n"
+                                      f"Destination: {dest_path}\n{error}")
+                else:
+                    self.successful_files.append(source_path)
+                pulled_files, pulled_bytes = self._pulled.get(device_file.folder, (0, 0))
+                self._pulled[device_file.folder] = (pulled_files + 1, pulled_bytes + device_file.size)
+                if self.catalog:
+                    with trace_span(self.tracer, 'catalog'):
+                        self.catalog.record(source_path, dest_path, device_file.folder, fingerprint,
+                                            integrity_error=error, device_mtime=device_file.mtime)
+                self._emit('file_done', folder=device_file.folder, path=source_path,
+                           dest_path=dest_path, size=device_file.size, error=error)
+                if self.mirror:
+                    mirror_task = asyncio.ensure_future(self._mirror_file(device_file, dest_path, root))
+                    self._mirror_tasks.add(mirror_task)
+                    mirror_task.add_done_callback(self._mirror_tasks.discard)
+            else:
+                self.failed_files.append(source_path)
+                if self.catalog:
+                    self.catalog.add_retry(source_path, device_file.folder)
+                self._log_failure(f"Failed to backup: {source_path}\nDestination: {dest_path}")
+                self._emit('file_failed', folder=device_file.folder, path=source_path,
+                           dest_path=dest_path, size=device_file.size, error=error)
+        finally:
+            self._claimed_dests.discard(os.path.normcase(dest_path))
+            if done is not None:
+                del self._inflight[fingerprint]
+                done.set()
+
+    def _claim_dest(self, dest_folder, source_path):
+        """Pick a destination path that no other file is using
+
+        Folders are scanned recursively, so files from different
+        subdirectories can share a name, and a device path can be reused for
+        new content once the original was removed. A numbered name is used
+        whenever the path is being pulled by another worker or already holds
+        a file, so an existing backup is never overwritten.
+        """
+        name = os.path.basename(source_path)
+        base, ext = os.path.splitext(name)
+        number = 0
+        while True:
+            dest_path = os.path.join(dest_folder, f"{base}_{number}{ext}" if number else name)
+            key = os.path.normcase(dest_path)
+            if key not in self._claimed_dests and not os.path.exists(dest_path):
+                self._claimed_dests.add(key)
+                return dest_path
+            number += 1
+
+    async def _classify(self, source_path, size, mtime, fingerprint, confirm=True):
+        """Decide whether a device file needs pulling (shared by run() and plan())
+
+        Returns ('backed_up', dest_path) when this very path was backed up
+        before and is unchanged (see _backed_up_copy) - no hashing needed.
+        Returns ('duplicate', dest_path) when another backed up file has the
+        same content, else ('new', None). fingerprint may be None for files
+        that were not fingerprinted; they are never duplicates. With
+        confirm=False duplicates are not confirmed by a full hash.
+        """
+        existing_copy = self._backed_up_copy(source_path, size, mtime, fingerprint)
+        if existing_copy:
+            return 'backed_up', existing_copy
+        if not fingerprint:
+            return 'new', None
+        existing_copy = await self._find_copy(source_path, fingerprint, confirm)
+        if existing_copy:
+            return 'duplicate', existing_copy
+        return 'new', None
+
+    def _backed_up_copy(self, source_path, size, mtime, fingerprint=None):
+        """Return the existing copy of an unchanged device file, or None
+
+        A file is unchanged when the catalog has its path with the same size
+        and either the same device mtime or, failing that, the same
+        fingerprint. Matching by fingerprint stores the mtime, so the next
+        run needs no fingerprint for the file.
+        """
+        entry = self.catalog.find_entry(source_path)
+        if not entry or entry[0] != size or not os.path.exists(entry[2]):
+            return None
+        if mtime and entry[3] == mtime:
+            return entry[2]
+        if fingerprint and entry[1] == fingerprint:
+            if mtime:
+                self.catalog.set_device_mtime(source_path, mtime)
+            return entry[2]
+        return None
+
+    async def _find_copy(self, source_path, fingerprint, confirm=True):
+        """Return an existing backup with the same content as a device file, or None
+
+        Candidates sharing the cheap fingerprint are confirmed by a full hash
+        unless confirm is False.
+        """
+        device_hash = None
+        loop = asyncio.get_event_loop()
+        for dest_path, full_hash in self.catalog.find_candidates(fingerprint):
+            if not os.path.exists(dest_path):
+                continue
+            if not confirm:
+                return dest_path
+            if full_hash is None:
+                full_hash = await loop.run_in_executor(None, file_md5, dest_path)
+                self.catalog.set_full_hash(dest_path, full_hash)
+            if device_hash is None:
+                device_hash = await self.get_device_md5(source_path)
+                if not device_hash:
+                    return None
+            if device_hash == full_hash:
+                return dest_path
+        return None
+
+    async def _pull(self, source_path, dest_path, root, size):
+        """Pull one file with retries; returns (success, error)
+
+        The file is pulled next to dest_path and only moved into place once
+        it has the device's size, so a failed pull never touches an existing
+        file. Only short copies are retried: a complete copy that fails the
+        integrity check is malformed on the device too, so it is kept and
+        returned as (True, description of the problem).
+        """
+        temp_path = dest_path + PARTIAL_SUFFIX
+        try:
+            error = None
+            for attempt in range(1, self.retries + 1):
+                disconnected = False
+                try:
+                    async with self._root_slots[root], self.limiter:
+                        self._partial_files.add(temp_path)
+                        try:
+                            # -a keeps the device timestamp so files are dated by when they were taken
+                            returncode, _, stderr = await self.adb('pull', '-a', source_path, temp_path,
+                                                                   timeout=self.timeout + size / MIN_PULL_THROUGHPUT)
+                        finally:
+                            self._partial_files.discard(temp_path)
+                    if returncode == 0:
+                        # A zero exit code doesn't guarantee a whole file
+                        pulled_size = os.path.getsize(temp_path)
+                        if pulled_size == size:
+                            with trace_span(self.tracer, 'integrity check'):
+                                error = await asyncio.get_event_loop().run_in_executor(
+                                    None, check_media_integrity, temp_path, None, dest_path)
+                            os.replace(temp_path, dest_path)
+                            self.limiter.record_success(size)
+                            if error:
+                                error = f"Integrity check failed: {error}"
+                            return True, error
+                        error = f"Short read: {pulled_size} of {size} bytes"
+                        self._discard(temp_path)
+                    else:
+                        error = stderr.strip() or f"adb pull exited with {returncode}"
+                        disconnected = ("error: device offline" in stderr
+                                        or "error: no devices/emulators found" in stderr)
+                except asyncio.TimeoutError:
+                    error = "Timeout"
+                except OSError as e:
+                    error = str(e)
+                self.limiter.record_failure()
+                if disconnected:
+                    self._emit('device_disconnected', path=source_path)
+                    await self.wait_for_device()
+                    continue
+                self._emit('file_retry', path=source_path, attempt=attempt, error=error)
+            self._discard(temp_path)
+            return False, error
+        except BaseException:
+            # Cancelled by cancel() or Ctrl+C - don't leave the partial copy behind
+            self._discard(temp_path)
+            raise
+
+    async def _mirror_file(self, device_file, dest_path, root):
+        """Copy a freshly pulled file to the mirror roots"""
+        errors = await asyncio.get_event_loop().run_in_executor(
+            self.mirror.executor, self.mirror.replicate, dest_path, root)
+        for error in errors:
+            self._log_failure(f"Failed to mirror: {dest_path}\n{error}")
+            self._emit('mirror_failed', folder=device_file.folder, path=device_file.path,
+                       dest_path=dest_path, size=device_file.size, error=error)
+        if not errors:
+            self._emit('file_mirrored', folder=device_file.folder, path=device_file.path,
+                       dest_path=dest_path, size=device_file.size)
+
+    def bytes_in_flight(self):
+        """Return how many bytes the running pulls have written so far"""
+        total = 0
+        for path in list(self._partial_files):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def _discard(self, dest_path):
+        """Delete a bad copy so it is never organized or catalogued"""
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+
+    def _concurrency_changed(self, limit):
+        if self.tracer:
+            self.tracer.counter('concurrent transfers', limit)
+        self._emit('concurrency_changed', count=limit)
+
+    def _log_failure(self, message):
+        if not self.failure_log:
+            return
+        try:
+            with trace_span(self.tracer, 'failure log'), open(self.failure_log, 'a') as f:
+                f.write(f"{message}\n")
+                f.write(f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+                f.write("-" * 50 + "\n")
+        except OSError:
+            pass
+
+    # Watch mode
+
+    def _reset(self):
+        """Forget the results of the previous run"""
+        self.folder_inventory = {}
+        self.successful_files = PathStore()
+        self.failed_files = PathStore()
+        self.suspect_files = PathStore()
+        self.failed_folders = []
+        self.duplicates_skipped = 0
+        self.already_backed_up = 0
+
+    async def watch(self, poll_interval: float = 60, marker: str = WATCH_MARKER,
+                    retry_interval: float = WATCH_RETRY_INTERVAL):
+        """Back up new media as it appears; yields a BackupResult for each pass
+
+        While idle each poll is a single adb shell call running one find
+        against the marker file, so CPU and USB use stay negligible. The
+        marker advances after every pass unless a folder could not be read.
+        Failed files go to the catalog's retry list instead, and are tried
+        again every retry_interval seconds until WATCH_MAX_ATTEMPTS.
+        """
+        folders = ' '.join(f'"{folder}"' for folder in self.folders)
+        check = (f'if [ -f "{marker}" ]; then '
+                 f'find {folders} -type f -newer "{marker}" {find_name_filter()} 2>/dev/null | head -n 1; '
+                 f'else echo NO_MARKER; fi')
+        last_retry = time.monotonic()
+        self._cancelled = False
+        while not self._cancelled:
+            if not await self.wait_for_device(poll_interval):
+                return
+            if self.catalog and self.catalog.device == 'unknown':
+                self.catalog.device = await self.get_device_serial()
+            try:
+                _, stdout, _ = await self.adb('shell', check, timeout=600)
+            except (OSError, asyncio.TimeoutError):
+                await self._sleep(poll_interval)
+                continue
+            new_media = bool(stdout.strip())
+            retry_due = (self.catalog is not None and time.monotonic() - last_retry >= retry_interval
+                         and self.catalog.pending_retries())
+            if not new_media and not retry_due:
+                await self._sleep(poll_interval)
+                continue
+
+            if self._cancelled:
+                return
+            self._reset()
+            retry_inventories = {}
+            if retry_due:
+                last_retry = time.monotonic()
+                retry_inventories = await self._retry_inventories()
+            if new_media:
+                # Files written while this pass runs are newer than the next marker
+                await self.adb('shell', f'touch "{marker}.next"', timeout=60)
+            self.newer_than = None if stdout.strip() == 'NO_MARKER' else marker
+            try:
+                for folder in self.folders:
+                    if new_media:
+                        folder_inventory = await self.scan_folder(folder)
+                    else:
+                        folder_inventory = FolderInventory(folder, DeviceFileList(folder))
+                    if folder in retry_inventories and not folder_inventory.error:
+                        folder_inventory = self._merge_files(folder_inventory, retry_inventories[folder])
+                    self.folder_inventory[folder] = folder_inventory
+                result = await self.run()
+            finally:
+                self.newer_than = None
+            if result.cancelled:
+                return
+            if self.catalog:
+                # Retried files that did not fail again are off the list
+                succeeded = set()
+                for folder, files in retry_inventories.items():
+                    if folder in self.folders and folder not in result.failed_folders:
+                        succeeded.update(files.paths)
+                for path in result.failed_files:
+                    succeeded.discard(path)
+                for path in succeeded:
+                    self.catalog.remove_retry(path)
+                self.catalog.commit()
+            if new_media and not result.failed_folders:
+                await self.adb('shell', f'mv "{marker}.next" "{marker}"', timeout=60)
+            yield result
+
+    async def _retry_inventories(self):
+        """Stat the files on the retry list, as a DeviceFileList per folder
+
+        Files that are gone from the device are dropped from the list.
+        """
+        folders = dict(self.catalog.pending_retries())
+        inventories = {}
+        present = set()
+        script = 'while IFS= read -r f; do stat -c "%s %Y %n" "$f" 2>/dev/null; done'
+        async for batch, stdout in self._shell_batches(script, list(folders)):
+            if stdout is None:
+                present.update(batch)  # Unknown - keep them for the next retry
+                continue
+            for line in stdout.splitlines():
+                parts = line.rstrip('\r').split(' ', 2)
+                if len(parts) == 3 and parts[0].isdigit() and parts[2] in folders:
+                    present.add(parts[2])
+                    folder = folders[parts[2]]
+                    files = inventories.setdefault(folder, DeviceFileList(folder))
+                    files.append(parts[2], int(parts[0]), int(parts[1]) if parts[1].isdigit() else 0)
+        for path in folders:
+            if path not in present:
+                self.catalog.remove_retry(path)
+        return inventories
+
+    def _merge_files(self, folder_inventory, extra_files):
+        """Add files to a FolderInventory, skipping paths it already has"""
+        extra_paths = set(extra_files.paths)
+        files = DeviceFileList(folder_inventory.folder)
+        for device_file in folder_inventory.files:
+            if device_file.path not in extra_paths:
+                files.append(device_file.path, device_file.size, device_file.mtime)
+        for device_file in extra_files:
+            files.append(device_file.path, device_file.size, device_file.mtime)
+        return FolderInventory(folder_inventory.folder, files)
+
+    # Cleanup
+
+    async def remove_backed_up_files(self, paths: Optional[List[str]] = None) -> PathStore:
+        """Delete backed up files from the device; returns the paths NOT removed
+
+        Defaults to every file successfully pulled by this session. Only
+        failures are reported back, so removal streams through any number of
+        files without building a list of them.
+        """
+        if paths is None:
+            paths = self.successful_files
+        script = 'while IFS= read -r f; do rm "$f" 2>/dev/null || echo "$f"; done'
+        failed = PathStore()
+        async for batch, stdout in self._shell_batches(script, paths):
+            if stdout is None:
+                failed.extend(batch)
+                continue
+            for line in stdout.splitlines():
+                line = line.rstrip('\r')
+                if line:
+                    failed.append(line)
+        return failed
@@ -15,6 +15,7 @@ def install_requirements():
         'requests',
         'pathlib',
         'typing',
+        'Pillow',  # Optional: thumbnail cache
     ]
     
     # Install each requirement